@@ -1,170 +1,167 @@
 # The following code takes the raw server data and turns it into a panel
 # We do a conservative imputation of missing observations in the dataset.
+# Every step of this is done per domain, so when N_PARTITIONS is set the domains are split
+# into that many buckets on disk which are then balanced independently in parallel.
+# In incremental mode the panel is only balanced again for the domains whose observations
+# changed since the last run, and the rest of the panel is kept as it was.
 import pandas as pd
 import numpy as np
+import hashlib
+import inspect
+import os
 from utils import *
 
-# Load the raw header data
-df = pd.read_csv('output/servers_panel.txt.gz', sep="\t",compression='gzip')
-
-# Clean the dates
-dates = pd.read_csv("output/encoded_dates.txt.gz", sep="\t", compression='gzip')
-dates['dt'] = pd.to_datetime(dates['dm'],format='%Y%m')
-dates = dates.loc[dates['dt'].notnull()]
-dates = dates.loc[dates['yr'].notnull()]
-dates = dates.loc[(dates['yr']>=2000) & (dates['yr']<=2018)]
-df = pd.merge(df,dates,on='date')
-del df['date']
-
-# Clean the target urls into domains 
-# (some have paths or sufffixes that need to be removed)
-domains = df[['target_url']].drop_duplicates()
-domains['domain'] = domains['target_url'].apply(extract_domain)
-df = pd.merge(df,domains,on='target_url',how='left')
-
-# Add the encoded the server version and vendor
-servers = pd.read_csv("output/encoded_servers.txt.gz",
-    sep="\t",
-    compression='gzip',
-    usecols=['server','server_name','server_version'])
-df = pd.merge(df,servers,on='server',how='left')
-df['server_name'] = df['server_name'].fillna("")
-df['server_version'] = df['server_version'].fillna("")
-
-
-# In the event that we have more than one observation per month then we want to use
-# the one observation that has the server vendor and version data
-# (i.e. if you have two observations in a month and only one has data then keep the one with data).
-# We also want to take the server vendor and version number that is modal in the case where a firm
-# used multiple server vendors and versions within a month.
-# We do this by flagging the observations
-# For observations with server vendor and version, then we use the number of observations of that.
-# -1 if the vendor is there but not the version
-# -2 if the vendor and the version are missing
-# Then we sort ascending and pick the first observation.
-obs_per_server = df.groupby(['domain','dt','server_name','server_version']).size()
-obs_per_server.name = 'obs'
-obs_per_server = obs_per_server.reset_index()
-
-df = pd.merge(df,obs_per_server,on=['domain','dt','server_name','server_version'],how='left')
-df.loc[
-    (df['server_name'].notnull()) | (df['server_version'].isnull()),
-    'obs'
-    ] = -1
-
-df.loc[
-    (df['server_name'].isnull()) & (df['server_version'].isnull()),
-    'obs'
-    ] = -2
-
-df = df.sort_values(['domain','dt','obs'],ascending=[True,True,False])
-df = df.groupby(['domain','dt']).first()
-df = df.reset_index()
-del df['obs']
-
-# Impute missing observations.
-# The idea here is that if we see a server vendor and version in one month and then again in another with a gap
-# we should fill that in and assume that they continued using the same vendor and version.
-# But if they change and there is a gap before that then you definitely don't want to do impute those because
-# we don't actually know exactly which month they switched.
-df = df.sort_values(['domain','dt'])
-df = df[['domain','dt','server_name','server_version']]
-
-# Start by making all of the observations where we don't have data be blank strings.
-# The reason for this is that we don't want to impute over times when we have a snapshot
-# but the snapshot wasn't one of the major server vendors or versions.
-# That is still observed data.
-for col in ['server_name','server_version']:
-    df.loc[
-        df[col]=='',
-        col
-    ] = np.NaN
-
-# Get all of the observations where we actually have data
-# and add a flag that these data observations are not interpolated.
-# Also going forward, find what the next observation's vendor and version are.
-observed_data = df.loc[df['server_name'].notnull()]
-for col in ['server_name','server_version']:
-    observed_data[col+"_next"] = observed_data.groupby(["domain"])[col].shift(-1)
-
-observed_data['interpolated'] = 0
-
-# For each domain, create a full range of monthly observations between the first time
-# we observe them in the data and the last time we observe them.
-domains = df[['domain']].drop_duplicates()
-domains['key'] = 1
-dts = pd.DataFrame(pd.date_range(min(df.dt),max(df.dt),freq='MS'),columns=['dt'])
-dts['key'] = 1
-
-# Add to the data information on the first observation and last observation
-first_ob = df.groupby("domain")['dt'].min()
-first_ob.name = 'dt_first'
-first_ob = first_ob.reset_index()
-
-last_ob = df.groupby("domain")['dt'].max()
-last_ob.name = 'dt_last'
-last_ob = last_ob.reset_index()
-
-# Join the domains with the full balanced set of observations to make each domain balanced.
-m = pd.merge(domains,dts,on='key')
-m = pd.merge(m,first_ob,on='domain')
-m = pd.merge(m,last_ob,on='domain')
-m = m.loc[
-        (m['dt']>=m['dt_first']) &
-        (m['dt']<=m['dt_last'])
-    ]
-del m['dt_first']
-del m['dt_last']
-
-# Attached the observed data to the balanced panel
-m = pd.merge(m,observed_data,on=['domain','dt'],how='left')
-del m['key']
-
-# Flag any observations that were not interpolated.
-m['interpolated'] = m['interpolated'].fillna(1)
-
-
-m.loc[(m['interpolated']==0) & (m['server_name'].isnull()),'server_name'] = ''
-m.loc[(m['interpolated']==0) & (m['server_version'].isnull()),'server_version'] = ''
-
-# This is where the interpolation really happens.
-# Start by filling forward the server vendor
-# If the observation is an interpolated observation
-# and the server vendor that is NOT the same as before
-# then do not fill that forward.
-m['server_name'] = m.groupby(['domain'])['server_name'].fillna(method='ffill')
-m['server_name_next'] = m.groupby(['domain'])['server_name_next'].fillna(method='ffill')
-m.loc[
-    (m['server_name']!=m['server_name_next']) &
-    (m['interpolated']==1)
-    ,
-    'server_name'
-    ] = np.NaN
-
-# Similarly fill forward the server version
-# If the observation is an interpolated observation
-# and the server version is NOT the same as before
-# then do not fill that forward. Also if the server vendor
-# changed then you want to not fill that forward too.
-m['server_version'] = m.groupby(['domain'])['server_version'].fillna(method='ffill')
-m['server_version_next'] = m.groupby(['domain'])['server_version_next'].fillna(method='ffill')
-m.loc[
-    (
-        (m['server_name']!=m['server_name_next']) |
-        (m['server_version']!=m['server_version_next'])
-    ) &
-    (m['interpolated']==1)
-    ,
-    'server_version'
-    ] = np.NaN
-
-
-# Get rid of any temporary data
-# Also turn the situations where we dont have data back to nulls
-m = m.loc[m['server_name'].notnull()]
-m = m[['domain','dt','server_name','server_version','interpolated']]
-m.loc[m['server_name']=='','server_name'] = np.NaN
-m.loc[m['server_version']=='','server_version'] = np.NaN
-
-# Export
-m.to_hdf('output/servers_panel_semibalanced.h5', 'df')
\ No newline at end of file
+def code_panel(df):
+    # Clean the dates
+    dates = read_table('encoded_dates', columns=['date_id','dm','yr'])
+    dates['dt'] = pd.to_datetime(dates['dm'],format='%Y%m')
+    dates = dates.loc[dates['dt'].notnull()]
+    dates = dates.loc[dates['yr'].notnull()]
+    dates = dates.loc[(dates['yr']>=2000) & (dates['yr']<=2018)]
+    months = pd.Series(month_code(dates['dt']), index=dates['date_id'].values)
+    df['month'] = df['date_id'].map(months).fillna(-1).astype(int)
+
+    # Code the encoded server vendor and version of each server header.
+    # Empty strings are missing values, the same as when the snapshot had no server header.
+    # The reason for this is that we don't want to impute over times when we have a snapshot
+    # but the snapshot wasn't one of the major server vendors or versions.
+    # That is still observed data.
+    servers = get_server_codes()
+    for col in ['server_name','server_version']:
+        ids = pd.Series(servers[col].values, index=servers['server_id'].values)
+        df[col.replace('server_','')+'_id'] = df['server_id'].map(ids).fillna(-1).astype(int)
+
+    # Snapshots without a date in the sample period or without a domain are not part of the panel
+    df = df.loc[(df['month']>=0) & (df['domain_id']>=0)]
+    return df
+
+def balance_the_panel(df):
+    # In the event that we have more than one observation per month then we want to use
+    # the one observation that has the server vendor and version data
+    # (i.e. if you have two observations in a month and only one has data then keep the one with data).
+    # We also want to take the server vendor and version number that is modal in the case where a firm
+    # used multiple server vendors and versions within a month.
+    with log_step('dedup', df) as step:
+        df = step.output(best_observations(df))
+
+    # Impute missing observations.
+    # The idea here is that if we see a server vendor and version in one month and then again in another with a gap
+    # we should fill that in and assume that they continued using the same vendor and version.
+    # But if they change and there is a gap before that then you definitely don't want to do impute those because
+    # we don't actually know exactly which month they switched.
+    df = pd.DataFrame({
+        'domain': from_codes(df['domain_id'].values, 'domain'),
+        'dt': month_start(df['month'].values),
+        'server_name': from_codes(df['name_id'].values, 'server_name'),
+        'server_version': from_codes(df['version_id'].values, 'server_version')
+        })
+
+    # Fill in the months between the observations of each domain.
+    # This works on each domain's observations as runs, so it only creates the rows that end up in the panel.
+    with log_step('ffill', df) as step:
+        m = step.output(balance_panel(df))
+
+    return m
+
+def balance_partition(part):
+    # The balanced parts keep their column types, so they are stored the same way as the full panel.
+    df = read_table(part)
+    path = "output/%s.h5" % part.replace('panel_codes','balanced')
+    # An empty table can't be written to HDF5, so an empty bucket is left out like one without any rows
+    m = balance_the_panel(df) if len(df)>0 else None
+    if m is not None and len(m)>0:
+        m.to_hdf(path, 'df', format='table')
+    return path
+
+def split_kept(changed):
+    # Splits the rows of the last run's panel that are kept by the bucket of their domain.
+    # The panel is read in blocks, so it never has to fit in memory.
+    clear_partitions('kept')
+    os.makedirs('output/partitions/kept')
+    for block in pd.read_hdf('output/servers_panel_semibalanced.h5', 'df', chunksize=1000000):
+        # The dictionaries may have changed since the last run
+        for col in CODED_COLUMNS:
+            block[col] = encode(block[col], col)
+        block = block.loc[block['domain'].notnull() & ~block['domain'].isin(changed)]
+        block_buckets = domain_buckets(block['domain'].cat.codes)
+        for bucket in np.unique(block_buckets):
+            block.loc[block_buckets==bucket].to_hdf("output/partitions/kept/part_%03d.h5" % bucket,
+                'df', format='table', append=True)
+    return ["output/partitions/kept/part_%03d.h5" % bucket for bucket in range(N_PARTITIONS)]
+
+if __name__ == '__main__':
+    # Load the coded header data
+    with log_step('load') as step:
+        df = read_table('panel_codes')
+        step.rows_in = len(df)
+        df['row'] = np.arange(len(df))
+        df = step.output(code_panel(df))
+        domains = read_table('dict_domains')
+    clear_partitions('balanced')
+
+    # Find the domains whose observations changed since the last run.
+    # Each domain's digest covers its observations and their snapshot counts in order, as the vendor
+    # and version strings that the server headers were encoded into, so changes to the encoding
+    # are picked up as well. It also covers the rank of each snapshot within its month in the order
+    # that the observation is picked by, since new snapshots of other domains can change the order
+    # in which the date strings first appear.
+    # Any change to the balancing code itself means that every domain is balanced again.
+    rules = hashlib.md5("".join([open(__file__).read(), str(MODAL_OBSERVATIONS)] + [inspect.getsource(f)
+        for f in [month_code, month_start, observation_order, best_observations, balance_panel]]).encode("utf8")).hexdigest()
+    with log_step('digests', df) as step:
+        rank = pd.Series(observation_order(df)).groupby([df['domain_id'].values, df['month'].values]).rank(method='first')
+        row_hashes = code_hashes(get_dictionary('server_name'))[df['name_id'].values]*np.uint64(31) + \
+            code_hashes(get_dictionary('server_version'))[df['version_id'].values]*np.uint64(17) + \
+            df['month'].values.astype('uint64') + df['n'].values.astype('uint64')*np.uint64(1000003) + \
+            rank.values.astype('uint64')*np.uint64(0x100000001B3)
+        digests = domain_digests(df['domain_id'].values, row_hashes)
+        digests.index = domains['domain'].values[digests.index]
+        manifest = read_manifest('servers_panel_semibalanced')
+        if manifest is not None and manifest['rules']==rules:
+            # Domains that are gone don't have a digest anymore, so they count as changed as well
+            old_digests = read_table('servers_panel_semibalanced_digests').set_index('domain')['digest']
+            changed = old_digests.index.difference(digests.index).append(
+                digests.index[digests!=old_digests.reindex(digests.index)])
+            df = df.loc[domains['domain'].isin(changed).values[df['domain_id'].values]]
+            kept = split_kept(changed)
+        else:
+            kept = None
+        step.output(df)
+    print("Balancing %d of %d domains" % (df['domain_id'].nunique(), len(digests)))
+
+    # Split the domains into buckets of consecutive domains and balance each one in a separate process
+    if N_PARTITIONS>1:
+        parts = write_partitions(df, domain_buckets(df['domain_id'].values), 'panel_codes')
+        del df
+        os.makedirs('output/partitions/balanced')
+        parts = map_partitions(balance_partition, parts)
+        clear_partitions('panel_codes')
+    else:
+        parts = [balance_the_panel(df) if len(df)>0 else None]
+
+    # Write the buckets out in order, together with the domains that were kept from the last run.
+    # The panel is a table indexed on the domain and the month, so slices of it can be read as well.
+    # The runs of each bucket are collected for the event log on the way.
+    events = []
+    with log_step('export') as step, HDFTableWriter('output/servers_panel_semibalanced.h5', ['domain','dt']) as f:
+        for bucket, m in enumerate(parts):
+            if isinstance(m, str):
+                m = pd.read_hdf(m, 'df') if os.path.exists(m) else None
+            if kept is not None and os.path.exists(kept[bucket]):
+                m = pd.concat([m, pd.read_hdf(kept[bucket], 'df')], axis=0)
+                m = m.sort_values(['domain','dt'], kind='mergesort')
+            if m is not None:
+                f.append(m)
+                events.append(panel_events(m))
+        step.rows_out = f.nrows
+    with log_step('events') as step:
+        events = pd.concat(events, ignore_index=True) if len(events)>0 else panel_events(pd.DataFrame())
+        write_table(step.output(events), 'servers_panel_events')
+    if kept is not None:
+        # The buckets only hold the domains that changed, so the later stages can't use them
+        clear_partitions('balanced')
+        clear_partitions('kept')
+
+    # Export
+    write_table(pd.DataFrame({'domain': digests.index, 'digest': digests.values}), 'servers_panel_semibalanced_digests')
+    write_manifest('servers_panel_semibalanced', {'rules': rules})
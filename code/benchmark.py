@@ -0,0 +1,130 @@
+# The following file benchmarks the pipeline from start to finish on synthetic inputs.
+# The inputs are written under a separate directory at the requested scale and every stage
+# of the pipeline (PIPELINE_STAGES in utils) is run there in its own process, the same way
+# make runs it. For each stage the wall time, the peak memory of its largest process and
+# the rows it reads per second are written to a JSON report. Given the report of an earlier run, the stages that got
+# slower by more than the tolerance are reported and the benchmark fails.
+import argparse
+import datetime
+import gzip
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+from make_synthetic_inputs import write_inputs
+from utils import PIPELINE_STAGES
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def count_rows(root, path):
+    # Counts the rows of an output from its metadata where it has any
+    path = os.path.join(root, path)
+    if path.endswith(".h5"):
+        with pd.HDFStore(path, "r") as store:
+            return store.get_storer("df").nrows
+    if path.endswith("offsets.npy"):
+        return np.load(path)[-1]
+    if path.endswith(".dta"):
+        with pd.io.stata.StataReader(path) as reader:
+            return reader.nobs
+    if path.endswith(".parquet"):
+        return ds.dataset(path).count_rows()
+    with gzip.open(path, "rt") as f:
+        return sum(1 for line in f) - 1
+
+def run_stage(root, script, env):
+    # Runs a stage in its own process and returns its wall time and the peak resident memory
+    # (in MB) of its largest process, which includes the worker processes that it started.
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.join(CODE_DIR, script + ".py")], cwd=root, env=env)
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    seconds = time.perf_counter() - start
+    if process.returncode!=0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+    return seconds, usage.ru_maxrss/1024
+
+def compare(report, baseline, tolerance):
+    # Returns the stages that are slower than in the baseline by more than the tolerance
+    before = {stage['stage']: stage for stage in baseline['stages']}
+    slower = []
+    for stage in report['stages']:
+        if stage['stage'] not in before:
+            continue
+        ratio = stage['seconds']/max(before[stage['stage']]['seconds'], 1e-9)
+        print("%-28s %8.2fs %8.2fs %6.2fx" % (stage['stage'], before[stage['stage']]['seconds'], stage['seconds'], ratio))
+        if ratio>1+tolerance:
+            slower.append(stage['stage'])
+    return slower
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks the pipeline on synthetic inputs.")
+    parser.add_argument("--root", default="output/benchmark", help="directory that the inputs and outputs are written to")
+    parser.add_argument("--report", default="output/benchmark.json")
+    parser.add_argument("--domains", type=int, default=1000)
+    parser.add_argument("--zips", type=int, default=2)
+    parser.add_argument("--crawl-files", type=int, default=4)
+    parser.add_argument("--months", type=int, default=36)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--reuse-inputs", action="store_true", help="keep the inputs of the last benchmark at the same root")
+    parser.add_argument("--baseline", help="report of an earlier run to compare the stages with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    # The outputs are always rebuilt from scratch
+    inputs = os.path.join(args.root, "input")
+    if not args.reuse_inputs or not os.path.exists(inputs):
+        if os.path.exists(inputs):
+            shutil.rmtree(inputs)
+        start = time.perf_counter()
+        snapshots = write_inputs(args.root, args.domains, args.zips, args.crawl_files, args.months, args.seed)
+        print("Wrote %d snapshots in %.1fs" % (snapshots, time.perf_counter() - start))
+        with open(os.path.join(args.root, "input/snapshots.txt"), "w") as f:
+            f.write("%d\n" % snapshots)
+    with open(os.path.join(args.root, "input/snapshots.txt")) as f:
+        snapshots = int(f.read())
+    if os.path.exists(os.path.join(args.root, "output")):
+        shutil.rmtree(os.path.join(args.root, "output"))
+    os.makedirs(os.path.join(args.root, "output"))
+
+    env = dict(os.environ, INCREMENTAL="0")
+    report = {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'scale': {'domains': args.domains, 'zips': args.zips, 'crawl_files': args.crawl_files,
+            'months': args.months, 'seed': args.seed, 'snapshots': snapshots},
+        'config': {name: os.environ.get(name) for name in ['N_JOBS','PANEL_FORMAT','N_PARTITIONS']},
+        'machine': {'cpus': os.cpu_count(), 'python': platform.python_version(), 'pandas': pd.__version__},
+        'stages': []
+    }
+    rows = {None: snapshots}
+    for script, stage in PIPELINE_STAGES.items():
+        print("Running %s" % script)
+        seconds, peak_rss_mb = run_stage(args.root, script, env)
+        rows[stage['outputs'][0]] = int(count_rows(args.root, stage['outputs'][0]))
+        report['stages'].append({
+            'stage': script,
+            'seconds': round(seconds, 3),
+            'peak_rss_mb': round(peak_rss_mb, 1),
+            'rows_in': rows[stage['source']],
+            'rows_out': rows[stage['outputs'][0]],
+            'rows_per_sec': round(rows[stage['source']]/seconds, 1)
+            })
+    report['total_seconds'] = round(sum(stage['seconds'] for stage in report['stages']), 3)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.report)), exist_ok=True)
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=2)
+    for stage in report['stages']:
+        print("%-28s %8.2fs %8.1f MB %12.0f rows/s" % (stage['stage'], stage['seconds'], stage['peak_rss_mb'], stage['rows_per_sec']))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = compare(report, json.load(f), args.tolerance)
+        if len(slower)>0:
+            sys.exit("Slower than the baseline: %s" % ", ".join(slower))
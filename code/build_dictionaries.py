@@ -0,0 +1,42 @@
+# The following code reads the raw header panel once and builds dictionaries of the unique
+# dates, servers and domains in it. Each snapshot is then stored as integer codes into those
+# dictionaries, so the later stages only ever parse the unique strings and join on integers.
+import pandas as pd
+import numpy as np
+from utils import *
+
+# Load the raw header data
+with log_step('load') as step:
+    df = step.output(read_table('servers_panel'))
+
+# Assign codes to the raw date and server header strings.
+# Missing values get the code -1 and are not part of the dictionaries.
+with log_step('code dates and servers', df) as step:
+    date_id, dates = pd.factorize(df['date'])
+    server_id, servers = pd.factorize(df['server'])
+    step.rows_out = len(dates) + len(servers)
+
+# Clean the target urls into domains
+# (some have paths or sufffixes that need to be removed)
+# and then assign codes to the domains.
+# The domains are sorted, so that sorting by the codes is the same as sorting by the domains.
+with log_step('code domains', df) as step:
+    url_id, urls = pd.factorize(df['target_url'])
+    urls = pd.DataFrame({'target_url': urls})
+    urls['domain'] = normalize_domains(urls['target_url'])
+    urls['domain_id'], domains = pd.factorize(urls['domain'], sort=True)
+    domain_id = np.where(url_id>=0, urls['domain_id'].values[url_id], -1)
+    step.rows_out = len(domains)
+
+# Export the dictionaries and the coded panel
+with log_step('export', df):
+    write_table(pd.DataFrame({'date_id': np.arange(len(dates)), 'date': dates}), 'dict_dates')
+    write_table(pd.DataFrame({'server_id': np.arange(len(servers)), 'server': servers}), 'dict_servers')
+    write_table(pd.DataFrame({'domain_id': np.arange(len(domains)), 'domain': domains}), 'dict_domains')
+    # Each row stands for n snapshots when they were aggregated as they were extracted
+    write_table(pd.DataFrame({
+        'domain_id': domain_id.astype('int32'),
+        'server_id': server_id.astype('int32'),
+        'date_id': date_id.astype('int32'),
+        'n': df['n'].values.astype('int32') if 'n' in df else np.ones(len(df), dtype='int32')
+        }), 'panel_codes')
@@ -0,0 +1,52 @@
+# The following code writes the balanced panel out as the panel store (see PanelStore in utils),
+# so that the server history of a single domain can be read without loading the whole panel.
+# The panel is already sorted by domain and month, so it is read in blocks and the codes of each
+# block are copied straight into the arrays, which are written to a new directory that replaces
+# the old store when it is done.
+import os
+import shutil
+import pandas as pd
+import numpy as np
+from utils import *
+
+with pd.HDFStore('output/servers_panel_semibalanced.h5', 'r') as store:
+    nrows = store.get_storer('df').nrows
+domains = get_dictionary('domain')
+
+path = PANEL_STORE + ".tmp"
+if os.path.exists(path):
+    shutil.rmtree(path)
+os.makedirs(path)
+arrays = {col: np.lib.format.open_memmap(os.path.join(path, col + ".npy"), mode='w+', dtype=dtype, shape=(nrows,))
+    for col, dtype in PANEL_STORE_COLUMNS.items()}
+counts = np.zeros(len(domains), dtype='int64')
+
+with log_step('copy') as step:
+    start = 0
+    last = -1
+    for block in pd.read_hdf('output/servers_panel_semibalanced.h5', 'df', chunksize=1000000):
+        end = start + len(block)
+        domain_id = block['domain'].cat.codes.values
+        if len(block)>0 and (domain_id[0]<last or (np.diff(domain_id)<0).any()):
+            raise ValueError("The balanced panel is not sorted by domain")
+        last = domain_id[-1] if len(block)>0 else last
+        counts += np.bincount(domain_id, minlength=len(domains))
+        arrays['month'][start:end] = month_code(block['dt'])
+        arrays['interpolated'][start:end] = block['interpolated'].values
+        for col in ['server_name','server_version']:
+            arrays[col][start:end] = block[col].cat.codes.values
+        start = end
+    step.rows_out = start
+
+# The rows of each domain start at the sum of the rows of the domains before it
+with log_step('export'):
+    for array in arrays.values():
+        array.flush()
+    del arrays
+    np.save(os.path.join(path, "offsets.npy"), np.concatenate([[0], np.cumsum(counts)]).astype('int64'))
+    np.save(os.path.join(path, "domains.npy"), string_dictionary(domains))
+    for col in ['server_name','server_version']:
+        np.save(os.path.join(path, col + "_dictionary.npy"), string_dictionary(get_dictionary(col)))
+    if os.path.exists(PANEL_STORE):
+        shutil.rmtree(PANEL_STORE)
+    os.replace(path, PANEL_STORE)
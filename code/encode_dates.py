@@ -1,33 +1,60 @@
 import pandas as pd
+from utils import *
 
-# Load the raw server header with the raw string data
-df = pd.read_csv('output/servers_panel.txt.gz', sep="\t",compression='gzip')
+# Load the unique raw date strings
+with log_step('load') as step:
+    dates = step.output(read_table('dict_dates'))
 
-# Find only the unique dates and only the date part of the timestaps
-dates = df[['date']].drop_duplicates()
+# Most of the dates are in one of the standard HTTP formats, so parse those directly
+with log_step('parse http dates', dates) as step:
+    dates['dt'], dates['path'] = parse_http_dates(dates['date'])
+    fast_dates = step.output(dates.loc[dates['dt'].notnull()])
+    dates = dates.loc[dates['dt'].isnull()]
+    del dates['dt']
+
+# For the rest find only the date part of the timestaps
 dates['date_short'] = dates['date'].str[4:16]
 short_dates = dates[['date_short']].drop_duplicates()
 
 # Convert the string dates into properly formatted dates
-short_dates['dt'] = pd.to_datetime(short_dates['date_short'],errors='coerce')
-short_dates = short_dates.loc[short_dates['dt'].notnull()]
-short_dates = pd.merge(dates,short_dates,on='date_short')
+with log_step('parse short dates', short_dates) as step:
+    short_dates['dt'] = pd.to_datetime(short_dates['date_short'],errors='coerce')
+    short_dates = short_dates.loc[short_dates['dt'].notnull()]
+    short_dates = pd.merge(dates,short_dates,on='date_short')
+    short_dates['path'] = 'short'
+    step.output(short_dates)
+
+with log_step('parse full dates') as step:
+    remaining_dates = dates.loc[~dates['date_short'].isin(short_dates['date_short'])]
+    step.rows_in = len(remaining_dates)
+    remaining_dates['dt'] = pd.to_datetime(remaining_dates['date'],errors='coerce')
+    remaining_dates['path'] = 'full'
+    remaining_dates = step.output(remaining_dates.loc[remaining_dates['dt'].notnull()])
 
-remaining_dates = dates.loc[~dates['date_short'].isin(short_dates['date_short'])]
-remaining_dates['dt'] = pd.to_datetime(remaining_dates['date'],errors='coerce')
-remaining_dates = remaining_dates.loc[remaining_dates['dt'].notnull()]
+# Report how many rows of the panel were parsed in each way,
+# weighting each date string by the number of snapshots it appears in
+rows = read_table('panel_codes', columns=['date_id','n']).groupby('date_id')['n'].sum()
+paths = pd.concat([fast_dates[['date_id','path']],short_dates[['date_id','path']],remaining_dates[['date_id','path']]],axis=0)
+paths['rows'] = paths['date_id'].map(rows).fillna(0).astype('int64')
+print("Parsed %d of %d rows (%d of %d unique dates):" % (paths['rows'].sum(), rows.sum(), len(paths), len(fast_dates)+len(dates)))
+for path, n in paths.groupby('path')['rows'].sum().sort_values(ascending=False).items():
+    print("  %s: %d" % (path, n))
+del rows
 
 # Extract both the date, month, and year
-dates = pd.concat([short_dates,remaining_dates],axis=0)
-dates['dt'] = pd.to_datetime(dates['dt'],errors='coerce',utc=True)
-dates['dm'] = dates['dt'].dt.strftime("%Y%m")
-dates['yr'] = dates['dt'].dt.strftime("%Y")
-dates['yr'] = pd.to_numeric(dates['yr'],errors='coerce')
+with log_step('format dates', paths) as step:
+    dates = pd.concat([fast_dates,short_dates,remaining_dates],axis=0)
+    dates['dt'] = pd.to_datetime(dates['dt'],errors='coerce',utc=True)
+    dates['dm'] = dates['dt'].dt.strftime("%Y%m")
+    dates['yr'] = dates['dt'].dt.strftime("%Y")
+    dates['yr'] = pd.to_numeric(dates['yr'],errors='coerce')
+    step.output(dates)
 
 # Drop any dates where we don't have a year
 dates = dates.loc[dates['yr'].notnull()]
 del dates['date_short']
+del dates['path']
 
 # Export
-dates.to_csv("output/encoded_dates.txt.gz", 
-    sep="\t", compression='gzip', index=False)
+with log_step('export', dates):
+    write_table(dates, 'encoded_dates')
@@ -1,20 +1,20 @@
 # The following code converts the unique server header strings into parsed
 # information about the server vendor and the version number.
 import pandas as pd
-from distutils.version import LooseVersion
 from utils import *
 
 # Get the unique servers
-df = pd.read_csv("output/servers_panel.txt.gz", 
-     sep="\t",
-     compression='gzip',
-     usecols=['server'])
-df = df.loc[df['server'].notnull()]
-df = df[['server']].drop_duplicates()
+with log_step('load') as step:
+    df = step.output(read_table('dict_servers'))
 
 # Encode the servers
-df['server_name'], df['server_version'] = zip(*df['server'].apply(encode_server_string))
-df['version_clean'] = df['server_version'].apply(clean_version)
+with log_step('classify servers', df) as step:
+    servers = classify_servers(df['server'])
+    df['server_name'] = servers['server_name']
+    df['server_version'] = servers['server_version']
+    versions = df['server_version'].drop_duplicates()
+    df['version_clean'] = df['server_version'].map(dict(zip(versions, versions.map(clean_version))))
+    step.output(df)
 
 # We only keep the server version numbers that are for the major server vendors
 df_versions = df.loc[(df['server_name'].isin(['Apache','Nginx','IIS','iPlanet'])) & \
@@ -22,18 +22,19 @@ df_versions = df.loc[(df['server_name'].isin(['Apache','Nginx','IIS','iPlanet'])
      ,['server_name','server_version','version_clean']].drop_duplicates()
 
 # For each version number also attach when that version became available.
-df_versions['version_clean'] = df_versions['version_clean'].apply(LooseVersion)
-versions_dict = get_version_dict()
-df_versions['begin_avail'] = df_versions.apply(find_version_begin_avail, axis=1, args=(versions_dict,))
-df_versions['version_clean'] = df_versions['version_clean'].apply(str)
+with log_step('merge begin_avail', df_versions) as step:
+    df_versions = step.output(pd.merge(df_versions,get_version_registry().begin_avail_table(),
+         on=['server_name','version_clean'],
+         how='left'))
 
 # Attach that data to the output, remembering that we only have information for the versions
 # of the major software vendors so make sure to left join
 del df['version_clean']
-servers_with_date = pd.merge(df,df_versions,
-     on=['server_name','server_version'],
-     how='left')
+with log_step('merge versions', df) as step:
+    servers_with_date = step.output(pd.merge(df,df_versions,
+         on=['server_name','server_version'],
+         how='left'))
 
 # Export the data
-servers_with_date.to_csv("output/encoded_servers.txt.gz", 
-     sep="\t", compression='gzip', index=False)
+with log_step('export', servers_with_date):
+    write_table(servers_with_date, 'encoded_servers')
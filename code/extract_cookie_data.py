@@ -1,56 +1,133 @@
 # The following file extracts the server name and ip addresses from the raw header data
 # provided by the Internet Archive.
+# Every crawl file inside the zips is handled by its own worker process. The worker streams
+# the snapshots line by line and writes them to disk in fixed size batches, so memory use
+# stays flat no matter how large the archive is.
+# Each crawl file gets its own part, which is recorded in a manifest along with the checksum
+# of the crawl file. In incremental mode only the crawl files that are not in the manifest
+# yet, or whose checksum changed, are extracted again.
 import pandas as pd
-import json
-import numpy as np
 import glob
+import gzip
+import hashlib
+import inspect
+import io
+import os
+import shutil
+import sys
 import zipfile
+from multiprocessing import Pool
+from utils import *
 
-# Initialize an array to store the extracted header data.
-output = []
+# With parquet the parts make up the partitioned output table directly.
+# The gzip parts are concatenated into a single file at the end.
+# The parts are named so that they sort in the order of the zips and the crawl files in them,
+# followed by the API data.
+if PANEL_FORMAT=='parquet':
+    PARTS_DIR = table_path("servers_panel")
+    PART_EXT = "parquet"
+else:
+    PARTS_DIR = "output/servers_panel_parts"
+    PART_EXT = "txt.gz"
+BATCH_SIZE = 100000
 
-# Go through each of the raw data files
-zip_files = glob.glob("input/ia/kenji/archive.org/~kenji/wayback-response-headers/*.zip")
-for zip_file in zip_files:
-    with zipfile.ZipFile(zip_file, "r") as f:
-        for crawl_file in f.namelist():
-            # If the raw data file is just errors then skip it.
-            if crawl_file.endswith(".err"):
+def extract_crawl_file(task):
+    # With orjson the lines are parsed as bytes, without decoding them first.
+    zip_file, crawl_file, part_file = task
+    with log_step('extract %s/%s' % (os.path.basename(zip_file), crawl_file)) as step, \
+        zipfile.ZipFile(zip_file, "r") as z, \
+        z.open(crawl_file) as raw, \
+        TablePartWriter(part_file, SERVERS_PANEL_COLUMNS) as f:
+        batch = []
+        step.rows_out = 0
+        # Go through each of the snapshots within a raw data file
+        lines = raw if orjson is not None else io.TextIOWrapper(raw, encoding="utf8", newline="\n")
+        for crawl in lines:
+            # Some snapshots are empty. Skip those instead of trying to parse.
+            if not crawl.strip():
                 continue
-            data = f.read(crawl_file)
-            crawls = data.decode("utf8").strip().split("\n")
-            # Go through each of the snapshots within a raw data file
-            for crawl in crawls:
-                # Some snapshots are empty. Skip those instead of trying to parse.
-                if crawl=="":
+            batch.append(parse_snapshot(crawl))
+            if len(batch)>=BATCH_SIZE:
+                f.write(aggregate_snapshots(batch))
+                step.rows_out += len(batch)
+                batch = []
+        f.write(aggregate_snapshots(batch))
+        step.rows_out += len(batch)
+    print("Extracted %d snapshots from %s/%s at %.0f snapshots/s" % (step.rows_out,
+        os.path.basename(zip_file), crawl_file, step.rows_out/max(step.seconds, 1e-9)))
+    return part_file
+
+if __name__ == '__main__':
+    # Any change to how the snapshots are parsed or aggregated invalidates all of the parts
+    rules = hashlib.md5("".join([inspect.getsource(f) for f in [parse_snapshot, aggregate_snapshots, parse_http_dates]] +
+        [RE_HTTP_DATE.pattern, str(SERVERS_PANEL_COLUMNS), str(MISSING_STRINGS), str(MODAL_OBSERVATIONS), PART_EXT]).encode("utf8")).hexdigest()
+    manifest = read_manifest("servers_panel")
+    if manifest is None or manifest['rules']!=rules or not os.path.exists(PARTS_DIR):
+        if os.path.exists(PARTS_DIR):
+            shutil.rmtree(PARTS_DIR)
+        os.makedirs(PARTS_DIR)
+        manifest = {'rules': rules, 'parts': {}}
+
+    # Go through each of the raw data files
+    tasks = []
+    parts = {}
+    zip_files = sorted(glob.glob("input/ia/kenji/archive.org/~kenji/wayback-response-headers/*.zip"))
+    for zip_file in zip_files:
+        with zipfile.ZipFile(zip_file, "r") as f:
+            for i, info in enumerate(f.infolist()):
+                crawl_file = info.filename
+                # If the raw data file is just errors then skip it.
+                if crawl_file.endswith(".err"):
                     continue
-                # Parse to json
-                crawl_data = json.loads(crawl)
-                # Extract header, date, and the URI that was targeted by the Internet Archive
-                headers = crawl_data.get("Envelope",{}).get("Payload-Metadata",{}).get("HTTP-Response-Metadata",{}).get("Headers",{})
-                date = crawl_data.get("Envelope",{}).get("Payload-Metadata",{}).get("HTTP-Response-Metadata",{}).get("Headers",{}).get("Date",np.NaN)
-                header_metadata = crawl_data.get("Envelope",{}).get("WARC-Header-Metadata",None)
-                if header_metadata is None:
-                    header_metadata = crawl_data.get("Envelope",{}).get("ARC-Header-Metadata",None)
-                server = crawl_data.get("Envelope",{}).get("Payload-Metadata",{}).get("HTTP-Response-Metadata",{}).get("Headers",{}).get("Server",np.NaN)
-                target_url = header_metadata.get("Target-URI",np.NaN)
-                # Add these to the output as an observation
-                output.append({
-                    'target_url': target_url,
-                    'server': server,
-                    'date': date
-                })
-
-# Convert the output to a data frame for writing
-output = pd.DataFrame(output)
-
-# Load data that we got through the Internet Archive's API
-api_data = pd.read_json("input/extract_from_api/outputs/header.jl", lines=True)
-api_data.rename(columns={'Date':'date','Server': 'server'}, inplace=True)
-
-# Combine the raw data from the Internet Archive with the API data
-output = pd.concat([output,api_data],axis=0)
-
-# Export to a tab delimited file.
-output.to_csv("output/servers_panel.txt.gz", 
-    sep="\t", index=False,compression='gzip')
+                part_file = "%s/0-%s-%05d.%s" % (PARTS_DIR, os.path.basename(zip_file), i, PART_EXT)
+                parts[part_file] = {'zip': zip_file, 'member': crawl_file, 'crc': info.CRC, 'size': info.file_size}
+                if manifest['parts'].get(part_file)!=parts[part_file] or not os.path.exists(part_file):
+                    tasks.append((zip_file, crawl_file, part_file))
+
+    # The data that we got through the Internet Archive's API.
+    api_file = "input/extract_from_api/outputs/header.jl"
+    api_part = "%s/1-api.%s" % (PARTS_DIR, PART_EXT)
+    parts[api_part] = {'digest': file_digest(api_file)}
+    update_api = manifest['parts'].get(api_part)!=parts[api_part] or not os.path.exists(api_part)
+
+    # Remove the parts of crawl files that are gone
+    removed = [part_file for part_file in manifest['parts'] if part_file not in parts]
+    for part_file in removed:
+        if os.path.exists(part_file):
+            os.remove(part_file)
+
+    print("Extracting %d of %d crawl files" % (len(tasks), len(parts)-1))
+    if len(tasks)==0 and not update_api and len(removed)==0 and os.path.exists(table_path("servers_panel")):
+        # Leave the output untouched so that the later stages are not rerun
+        sys.exit()
+
+    with Pool(N_JOBS) as pool:
+        list(pool.imap(extract_crawl_file, tasks))
+
+    # Load data that we got through the Internet Archive's API.
+    # The header strings are kept as they are so that they are parsed the same way as the raw data.
+    if update_api:
+        with log_step('extract api') as step, TablePartWriter(api_part, SERVERS_PANEL_COLUMNS) as f:
+            api_data = pd.read_json(api_file, lines=True,
+                dtype=False, convert_dates=False, chunksize=BATCH_SIZE)
+            step.rows_out = 0
+            for chunk in api_data:
+                chunk.rename(columns={'Date':'date','Server': 'server'}, inplace=True)
+                f.write(aggregate_snapshots(chunk.reindex(columns=['target_url','server','date']).values.tolist()))
+                step.rows_out += len(chunk)
+
+    # Combine the raw data from the Internet Archive with the API data.
+    # Concatenated gzip members are themselves a valid gzip file,
+    # so the parts are copied over as is without recompressing them.
+    if PANEL_FORMAT!='parquet':
+        with open(table_path("servers_panel"), "wb") as f:
+            f.write(gzip.compress(("\t".join(SERVERS_PANEL_COLUMNS) + "\n").encode("utf8")))
+            for part_file in sorted(parts):
+                with open(part_file, "rb") as part:
+                    shutil.copyfileobj(part, f)
+    else:
+        # Parts that are rewritten in place don't change the modification time of the directory
+        os.utime(PARTS_DIR)
+
+    manifest['parts'] = parts
+    write_manifest("servers_panel", manifest)
@@ -0,0 +1,163 @@
+# The following file writes synthetic stand-ins for the proprietary inputs of the pipeline:
+# the zips of raw header data from the Internet Archive, the API data, the Orbis and Compustat
+# files and the CPI. The public inputs (the version lists, the IIS prices and the SUSB weights)
+# are copied over from input/ as they are. The data is random but shaped like the real data:
+# every domain is crawled a few times a month over a few years under a mix of url variants,
+# sticks with a server for a while before switching, and some of the headers are missing or
+# in one of the older date formats. It is used to benchmark the pipeline at any scale.
+import argparse
+import datetime
+import gzip
+import io
+import json
+import os
+import random
+import shutil
+import zipfile
+
+IA_DIR = "input/ia/kenji/archive.org/~kenji/wayback-response-headers"
+PUBLIC_INPUTS = [
+    "input/versions_with_dates.xlsx",
+    "input/apache_begin_avails.txt",
+    "input/nginx_begin_avails.txt",
+    "input/iis_prices.xlsx",
+    "input/susb_naics_weights.txt",
+    "input/susb_state_weights.txt"
+    ]
+
+# Server headers roughly in the proportions of the crawl, including the ones that
+# don't belong to any of the vendors and the ones that are missing.
+SERVERS = [
+    ("Apache", 10), ("Apache/2.2.15 (CentOS)", 8), ("Apache/2.2.22 (Ubuntu)", 6), ("Apache/2.4.7 (Ubuntu)", 5),
+    ("Apache/1.3.27 (Unix) mod_ssl/2.8.14 OpenSSL/0.9.7", 4), ("Apache/2.0.52 (Red Hat)", 4), ("IBM_HTTP_Server", 1),
+    ("Microsoft-IIS/5.0", 6), ("Microsoft-IIS/6.0", 9), ("Microsoft-IIS/7.5", 6), ("Microsoft-IIS/8.5", 3),
+    ("nginx", 5), ("nginx/1.10.3", 3), ("nginx/0.7.67", 2), ("Nginx", 1),
+    ("Netscape-Enterprise/4.1", 2), ("Netscape-Enterprise/6.0", 1), ("Sun-ONE-Web-Server/6.1", 1),
+    ("lighttpd/1.4.19", 1), ("GWS", 1), ("cloudflare", 2), ("", 1), (None, 3)
+    ]
+SUFFIXES = [("com", 70), ("org", 8), ("net", 8), ("co.uk", 3), ("com.au", 2), ("us", 2), ("biz", 1)]
+STATES = ["AL","AZ","CA","CO","CT","FL","GA","IL","MA","MI","MN","NC","NJ","NY","OH","PA","TX","VA","WA","GU","VI"]
+NAICS = [11, 21, 22, 23, 31, 32, 33, 42, 44, 45, 48, 49, 51, 52, 53, 54, 56, 61, 62, 71, 72, 81]
+
+def weighted(rng, choices):
+    values, weights = zip(*choices)
+    return rng.choices(values, weights=weights)[0]
+
+def make_domains(rng, n_domains):
+    return ["%s%d.%s" % (rng.choice(["acme","global","first","united","tech","data","net"]), i, weighted(rng, SUFFIXES))
+        for i in range(n_domains)]
+
+def make_url(rng, domain):
+    # The url variants that the url cleaners and the public suffix normalization have to undo
+    variants = [
+        "http://www.%s/", "http://%s/", "http://%s", "https://www.%s/", "http://www2.%s/index.html",
+        "http://ww.%s/", "http://%s:80/about/", "http://http//www.%s/", "http://1.%s/"
+        ]
+    return rng.choice(variants) % domain
+
+def make_date(rng, dt):
+    # Most dates are in the RFC 1123 format, the rest are in the two older formats or garbage
+    r = rng.random()
+    if r<0.9:
+        return dt.strftime("%a, %d %b %Y %H:%M:%S GMT")
+    if r<0.95:
+        return dt.strftime("%A, %d-%b-%y %H:%M:%S GMT")
+    if r<0.99:
+        return dt.strftime("%a %b ") + ("%2d" % dt.day) + dt.strftime(" %H:%M:%S %Y")
+    return rng.choice(["0", "Thu, 01 Jan 1970 00:00:00 GMT", "garbage"])
+
+def make_snapshot(rng, url, server, date):
+    headers = {"Content-Type": "text/html"}
+    if server is not None:
+        headers["Server"] = server
+    if date is not None:
+        headers["Date"] = date
+    # Older crawls have ARC instead of WARC metadata
+    metadata = "WARC-Header-Metadata" if rng.random()<0.7 else "ARC-Header-Metadata"
+    return json.dumps({
+        "Container": {"Filename": "crawl.warc.gz", "Compressed": True},
+        "Envelope": {
+            "Format": "WARC",
+            metadata: {"Target-URI": url, "WARC-Type": "response"},
+            "Payload-Metadata": {"HTTP-Response-Metadata": {"Response-Message": {"Status": "200"}, "Headers": headers}}
+            }
+        })
+
+def make_history(rng, domain, months):
+    # The snapshots of a domain in one crawl file: a few per month for a span of months,
+    # with the server switching now and then.
+    start = datetime.datetime(rng.randint(1998, 2016), rng.randint(1, 12), 1)
+    server = weighted(rng, SERVERS)
+    for month in range(rng.randint(1, months)):
+        if rng.random()<0.05:
+            server = weighted(rng, SERVERS)
+        if rng.random()<0.2:
+            continue
+        for _ in range(rng.randint(1, 4)):
+            dt = start + datetime.timedelta(days=30*month + rng.randint(0, 27), seconds=rng.randint(0, 86399))
+            yield make_snapshot(rng, make_url(rng, domain), server, make_date(rng, dt))
+
+def write_zips(rng, root, domains, n_zips, n_crawl_files, months):
+    # Each crawl file covers a random subset of the domains
+    os.makedirs(os.path.join(root, IA_DIR), exist_ok=True)
+    n = 0
+    for z in range(n_zips):
+        with zipfile.ZipFile(os.path.join(root, IA_DIR, "headers_%03d.zip" % z), "w", zipfile.ZIP_DEFLATED) as f:
+            for c in range(n_crawl_files):
+                with f.open("crawl_%03d.json" % c, "w") as raw, io.TextIOWrapper(raw, encoding="utf8") as out:
+                    for domain in rng.sample(domains, max(len(domains)//n_crawl_files, 1)):
+                        for snapshot in make_history(rng, domain, months):
+                            out.write(snapshot + "\n")
+                            n += 1
+                        if rng.random()<0.01:
+                            out.write("\n")
+            f.writestr("crawl_000.err", "error\n")
+    return n
+
+def write_inputs(root, n_domains=1000, n_zips=2, n_crawl_files=4, months=36, seed=0):
+    # Writes all of the inputs under root and returns the number of snapshots in the zips
+    rng = random.Random(seed)
+    domains = make_domains(rng, n_domains)
+    n = write_zips(rng, root, domains, n_zips, n_crawl_files, months)
+
+    os.makedirs(os.path.join(root, "input/extract_from_api/outputs"), exist_ok=True)
+    with open(os.path.join(root, "input/extract_from_api/outputs/header.jl"), "w") as f:
+        for domain in rng.sample(domains, max(n_domains//20, 1)):
+            f.write(json.dumps({"target_url": make_url(rng, domain), "Server": weighted(rng, SERVERS),
+                "Date": make_date(rng, datetime.datetime(rng.randint(1998, 2018), rng.randint(1, 12), rng.randint(1, 28)))}) + "\n")
+
+    with gzip.open(os.path.join(root, "input/orbis_location.txt.gz"), "wt") as f:
+        f.write("domain\tstate_us\n")
+        for domain in rng.sample(domains, n_domains//2):
+            f.write("%s\t%s\n" % (domain, rng.choice(STATES)))
+    with gzip.open(os.path.join(root, "input/orbis_naics.txt.gz"), "wt") as f:
+        f.write("domain\tnaics\tnaicsccod2017\n")
+        for domain in rng.sample(domains, n_domains//2):
+            naics = rng.choice(NAICS)
+            f.write("%s\t%d\t%d\n" % (domain, naics, naics*10000 + rng.randint(0, 9999)))
+    with gzip.open(os.path.join(root, "input/compustat_static.txt.gz"), "wt") as f:
+        f.write("domain\tstate\tnaics\tnaics6\n")
+        for domain in rng.sample(domains, n_domains//10):
+            naics = rng.choice(NAICS)
+            f.write("%s\t%s\t%d\t%d\n" % (domain, rng.choice(STATES), naics, naics*10000 + rng.randint(0, 9999)))
+    with gzip.open(os.path.join(root, "input/cpi.txt.gz"), "wt") as f:
+        f.write("dm\tcpi\n")
+        for year in range(1990, 2021):
+            for month in range(1, 13):
+                f.write("%d-%02d\t%.3f\n" % (year, month, 130 + (year-1990)*3.5 + month*0.3))
+
+    for path in PUBLIC_INPUTS:
+        shutil.copy(path, os.path.join(root, path))
+    return n
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Writes synthetic inputs for the pipeline under a directory.")
+    parser.add_argument("root")
+    parser.add_argument("--domains", type=int, default=1000)
+    parser.add_argument("--zips", type=int, default=2)
+    parser.add_argument("--crawl-files", type=int, default=4)
+    parser.add_argument("--months", type=int, default=36)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    n = write_inputs(args.root, args.domains, args.zips, args.crawl_files, args.months, args.seed)
+    print("Wrote %d snapshots" % n)
@@ -1,131 +1,239 @@
 import pandas as pd
 import numpy as np
+import os
 from utils import *
 
-# Load the interpolated balanced panel data
-df = pd.read_hdf('output/servers_panel_semibalanced.h5', 'df')
-
-# Drop the data that has empty information since we don't use this in our analysis
-df = df.loc[(df['server_name']!="")]
-df = df.loc[df['server_name'].notnull()]
-
-# Load the dates
-df['dt'] = pd.to_datetime(df['dt'])
-df['yr'] = df['dt'].dt.year
-df['dm'] = df['yr'].astype(int)*100 + 1
-
-# Subset the columns
-df = df[['domain','yr','dm','dt','server_name','server_version','interpolated']]
-
-# For each observed server version, add any information about it
-# This includes when it first became available.
-versions = versions = get_version_df()
-versions.rename(columns={
-    'name': 'server_name',
-    'version': 'server_version'
-}, inplace=True)
-versions = versions.loc[
-    (versions['server_name'].notnull()) & (versions['server_version'].notnull()) &
-    (versions['server_name']!='') & (versions['server_version']!='')
-    ]
-df = pd.merge(df,versions,
-    on=['server_name','server_version'],
-    how='left')
-
-# Find the most popular IIS version by each month and add that to every single observation.
-# We use this to interpolate the unobserved value of the open source observations.
-iis_popular_version = df.loc[df['server_name']=='IIS'].groupby(['yr'])['server_version'].agg(lambda x:x.value_counts().index[0])
-iis_popular_version = iis_popular_version.reset_index()
-iis_popular_version.rename(columns={'server_version': 'iis_popular_version'}, inplace=True)
-df = pd.merge(df,iis_popular_version,
-    on=['yr'],
-    how='left')
-
-# Load the prices of Microsoft software and attach those to the most popular version of IIS in each observation
-iis_prices = pd.read_excel("input/iis_prices.xlsx",
-    usecols=['server_version','price_2012_standard','price_2012_datacenter'])
-iis_prices.rename(columns={
-    'server_version': 'iis_popular_version',
-    'price_2012_standard': 'iis_pop_p2012s',
-    'price_2012_datacenter': 'iis_pop_p2012d'
-    },inplace=True)
-df = pd.merge(df,iis_prices,
-    on=['iis_popular_version'],
-    how='left')
-
-# Attached the CPI for each server version number based on when that 
-# server version became available.
-cpi = pd.read_csv("input/cpi.txt.gz", sep="\t",
-    compression='gzip')
-
-cpi.rename(columns={'dm': 'begin_avail_dm'},inplace=True)
-o = create_dms(df['begin_avail'])
-o.rename(columns={'dt': 'begin_avail', 'dm': 'begin_avail_dm'}, inplace=True)
-df = pd.merge(df,o,on=['begin_avail'],how='left')
-df = pd.merge(df,cpi,on=['begin_avail_dm'],how='left')
-
-# Add the states from the Orbis data
-orbis = pd.read_csv("input/orbis_location.txt.gz", sep="\t", compression='gzip',
-    usecols=['domain','state_us'])
-orbis.rename(columns={'state_us':'orbis_state', 'fips': 'orbis_fips', 'postcode': 'orbis_postcode'}, inplace=True)
-df = pd.merge(df,orbis,on=['domain'],how='left')
-
-# Add the NAICS codes from the Orbis data
-orbis = pd.read_csv("input/orbis_naics.txt.gz", sep="\t", compression='gzip',
-    usecols=['domain','naics','naicsccod2017'])
-orbis.rename(columns={'naics': 'orbis_naics', 'naicsccod2017': 'orbis_naics6'}, inplace=True)
-df = pd.merge(df,orbis,on=['domain'],how='left')
-
-# Add the Compustat data on NAICS and state
-compustat = pd.read_csv("input/compustat_static.txt.gz", sep="\t", compression='gzip')
-compustat.rename(columns={'state':'compustat_state', 'naics': 'compustat_naics', 'naics6': 'compustat_naics6'}, inplace=True)
-df = pd.merge(df,compustat,on=['domain'],how='left')
-
-
-# Combine Orbis and Compustat variables
-for variable in ['naics','naics6','state']:
-    df[variable] = np.NaN
-    df.loc[df[variable].isnull(),variable] = df['compustat_'+variable]
-    df.loc[df[variable].isnull(),variable] = df['orbis_'+variable]
-
-# Add the weights to the data to make it representative
-df.loc[df['naics']==32,'naics'] = 31
-df.loc[df['naics']==33,'naics'] = 31
-df.loc[df['naics']==45,'naics'] = 44
-df.loc[df['naics']==49,'naics'] = 48
-
-df_n = df.groupby(['state','naics','yr'])['domain'].nunique()
-df_n.name = 'sample_n_domains'
-df_n = df_n.reset_index()
-susb_naics_dfs = pd.read_csv("input/susb_naics_weights.txt",sep="\t")
-
-df = pd.merge(df,susb_naics_dfs,on=['state','naics','yr'],how='left')
-df = pd.merge(df,df_n,on=['state','naics','yr'],how='left')
-
-
-# Filter out firms in Guam and the U.S. Virgin Islands
-df = df.loc[~df['state'].isin(['GU',"VI"])]
-
-# Categorical
-print("Categorical")
-df['domain_id'] = df['domain'].astype('category').cat.codes
-df['server_name'] = df['server_name'].astype('category')
-df['server_version'] = df['server_version'].astype('category')
-
-# Derived variables
-df['susb_weights'] = df['susb_statenaics_firms']/df['sample_n_domains']
-df['begin_avail'] = pd.to_datetime(df['begin_avail'])
-
-# Delete any variables from proprietary data
-df = df[['domain', 'yr', 'dt',
-       'server_name','server_version',
-       'interpolated',
-       'susb_weights',
-       'cpi',
-       'iis_popular_version',
-       'iis_pop_p2012s','iis_pop_p2012d',
-       ]]
-
-# Export the dataset
-df.to_stata("output/servers_info_panel.dta",convert_dates={'dt': 'td'})
-
+# Every step below is done per domain except for two statistics: the most popular IIS version
+# and the number of sampled domains in each cell of the weights. So when the balanced panel is
+# split into domain buckets the dataset is built in two passes over the buckets. The first adds
+# everything that only depends on the domain and counts the statistics, which are then combined
+# across the buckets and merged onto every bucket in the second pass.
+# The second pass also sums each bucket up into the cells of the market share cube,
+# which are then summed up across the buckets in the same way.
+
+def add_domain_info(df):
+    # Drop the data that has empty information since we don't use this in our analysis
+    df = df.loc[(df['server_name']!="")]
+    df = df.loc[df['server_name'].notnull()]
+
+    # Load the dates
+    df['dt'] = pd.to_datetime(df['dt'])
+    df['yr'] = df['dt'].dt.year
+    df['dm'] = df['yr'].astype(int)*100 + 1
+
+    # Subset the columns
+    df = df[['domain','yr','dm','dt','server_name','server_version','interpolated']]
+
+    # For each observed server version, add any information about it
+    # This includes when it first became available.
+    versions = versions = get_version_df()
+    versions.rename(columns={
+        'name': 'server_name',
+        'version': 'server_version'
+    }, inplace=True)
+    versions = versions.loc[
+        (versions['server_name'].notnull()) & (versions['server_version'].notnull()) &
+        (versions['server_name']!='') & (versions['server_version']!='')
+        ]
+    # The vendors and versions in the panel are coded, so code the versions in the same way to merge on the codes
+    for col in ['server_name','server_version']:
+        versions[col] = pd.Categorical(versions[col], categories=df[col].cat.categories)
+    versions = versions.loc[versions['server_name'].notnull() & versions['server_version'].notnull()]
+    with log_step('merge versions', df) as step:
+        df = step.output(pd.merge(df,versions,
+            on=['server_name','server_version'],
+            how='left'))
+
+    # Add the states and the NAICS codes from the Orbis and Compustat data
+    with log_step('merge firms', df) as step:
+        firms = get_firm_info(df['domain'])
+        for variable in ['naics','naics6','state']:
+            df[variable] = firms[variable].values
+        step.output(df)
+
+    # Add the weights to the data to make it representative
+    df.loc[df['naics']==32,'naics'] = 31
+    df.loc[df['naics']==33,'naics'] = 31
+    df.loc[df['naics']==45,'naics'] = 44
+    df.loc[df['naics']==49,'naics'] = 48
+
+    # Count the observations of each IIS version in each year and the domains in each cell of the weights.
+    # The domains never span buckets, so both of these can be summed across the buckets.
+    # Each version's first observation in the panel, which is sorted by domain and month, is kept as well.
+    iis = df.loc[df['server_name']=='IIS']
+    iis_counts = pd.DataFrame({
+        'yr': iis['yr'].values,
+        'server_version': iis['server_version'].values,
+        'n': 1,
+        'first': iis['domain'].cat.codes.values.astype('int64')*12*10000 + month_code(iis['dt'])
+        }).groupby(['yr','server_version'], observed=True).agg({'n': 'sum', 'first': 'min'})
+    df_n = df.groupby(['state','naics','yr'])['domain'].nunique()
+    df_n.name = 'sample_n_domains'
+    return df, iis_counts, df_n
+
+def combine_stats(stats):
+    iis_counts = pd.concat([s[0] for s in stats]).groupby(level=['yr','server_version']).agg({'n': 'sum', 'first': 'min'})
+    df_n = pd.concat([s[1] for s in stats]).groupby(level=['state','naics','yr']).sum()
+
+    # Find the most popular IIS version by each year.
+    # Versions that are equally popular go to the one that is observed first, as with value_counts.
+    iis_counts = iis_counts.reset_index()
+    iis_counts['server_version'] = decode(iis_counts['server_version'])
+    iis_counts = iis_counts.sort_values(['yr','n','first'], ascending=[True,False,True])
+    by_yr = iis_counts.drop_duplicates('yr')[['yr','server_version']]
+    by_yr = by_yr.set_index('yr').rename(columns={'server_version': 'iis_popular_version'})
+
+    # Load the prices of Microsoft software and attach those to the most popular version of IIS in each year
+    iis_prices = pd.read_excel("input/iis_prices.xlsx",
+        usecols=['server_version','price_2012_standard','price_2012_datacenter'])
+    iis_prices.rename(columns={
+        'server_version': 'iis_popular_version',
+        'price_2012_standard': 'iis_pop_p2012s',
+        'price_2012_datacenter': 'iis_pop_p2012d'
+        },inplace=True)
+    iis_prices = iis_prices.drop_duplicates('iis_popular_version').set_index('iis_popular_version')
+    by_yr = by_yr.join(iis_prices, on='iis_popular_version')
+
+    # The CPI of each month
+    cpi = pd.read_csv("input/cpi.txt.gz", sep="\t",
+        compression='gzip')
+    cpi.index = month_code(pd.to_datetime(cpi['dm'], format='%Y-%m'))
+    cpi = cpi.loc[~cpi.index.duplicated(), ['cpi']]
+    return by_yr, cpi, df_n.reset_index()
+
+def add_weights(df, by_yr, cpi, df_n):
+    # Add the most popular IIS version and its prices to every single observation.
+    # We use this to interpolate the unobserved value of the open source observations.
+    with log_step('merge iis prices', df) as step:
+        for col, values in by_yr.reindex(df['yr'].values).items():
+            df[col] = values.values
+        step.output(df)
+
+    # Attached the CPI for each server version number based on when that
+    # server version became available.
+    with log_step('merge cpi', df) as step:
+        df['begin_avail'] = pd.to_datetime(df['begin_avail'])
+        begin_avail_month = np.where(df['begin_avail'].notnull(), month_code(df['begin_avail']), -1)
+        df['cpi'] = cpi['cpi'].reindex(begin_avail_month).values
+        step.output(df)
+
+    susb_naics_dfs = pd.read_csv("input/susb_naics_weights.txt",sep="\t")
+
+    with log_step('merge susb weights', df) as step:
+        df = step.output(pd.merge(df,susb_naics_dfs,on=['state','naics','yr'],how='left'))
+    with log_step('merge sample counts', df) as step:
+        df = step.output(pd.merge(df,df_n,on=['state','naics','yr'],how='left'))
+
+    # Derived variables
+    df['susb_weights'] = df['susb_statenaics_firms']/df['sample_n_domains']
+    return df
+
+def prepare_partition(path):
+    with log_step('load') as step:
+        df = step.output(pd.read_hdf(path, 'df'))
+    df, iis_counts, df_n = add_domain_info(df)
+    path = "output/partitions/analytical/%s" % os.path.basename(path)
+    df.to_hdf(path, 'df', format='table')
+    return path, iis_counts, df_n
+
+def finish_partition(task):
+    # Builds the final rows of a bucket. The buckets are made of consecutive domains,
+    # so the buckets in order make up the dataset in order.
+    path, lookups = task
+    df = add_weights(pd.read_hdf(path, 'df'), *lookups)
+    df = df.sort_values(['domain','dt'], kind='mergesort').reset_index(drop=True)
+    n = len(df)
+
+    # Filter out firms in Guam and the U.S. Virgin Islands
+    df = df.loc[~df['state'].isin(['GU',"VI"])]
+
+    # The cells of the market share cube are summed up by state and NAICS code before those are dropped
+    with log_step('cube', df) as step:
+        cells = step.output(cube_cells(df))
+
+    # Delete any variables from proprietary data
+    df['domain'] = decode(df['domain'])
+    df = df[['domain', 'yr', 'dt',
+           'server_name','server_version',
+           'interpolated',
+           'susb_weights',
+           'cpi',
+           'iis_popular_version',
+           'iis_pop_p2012s','iis_pop_p2012d',
+           ]]
+
+    # Keep what the header of the Stata file needs: the longest strings and the categories that are used.
+    # The rows are pickled, since HDF5 tables can't tell missing strings from the string "nan".
+    longest = {col: df[col].dropna().iloc[df[col].dropna().str.len().values.argmax()]
+        for col in df.columns[df.dtypes==object] if df[col].notnull().any()}
+    used = {col: np.bincount(df[col].cat.codes[df[col].cat.codes>=0], minlength=len(df[col].cat.categories))>0
+        for col in ['server_name','server_version']}
+    path = path.replace('.h5','.pkl')
+    df.to_pickle(path)
+    return path, n, len(df), longest, used, cells
+
+def split_panel():
+    # Splits the balanced panel into buckets of consecutive domains.
+    # The panel is read in blocks, so it never has to fit in memory.
+    os.makedirs('output/partitions/balanced')
+    parts = ["output/partitions/balanced/part_%03d.h5" % bucket for bucket in range(N_PARTITIONS)]
+    for block in pd.read_hdf('output/servers_panel_semibalanced.h5', 'df', chunksize=1000000):
+        buckets = domain_buckets(block['domain'].cat.codes)
+        for bucket in np.unique(buckets):
+            block.loc[buckets==bucket].to_hdf(parts[bucket], 'df', format='table', append=True)
+    return [part for part in parts if os.path.exists(part)]
+
+if __name__ == '__main__':
+    # Load the interpolated balanced panel data.
+    # When the panel was balanced in buckets those are used as they are,
+    # otherwise the full panel is split into buckets here or used as a single bucket.
+    parts = list_partitions('balanced')
+    split = len(parts)==0 and N_PARTITIONS>1
+    if split:
+        parts = split_panel()
+    elif len(parts)==0:
+        parts = ['output/servers_panel_semibalanced.h5']
+
+    # Build the firm information and the version registry before the workers start so that they share them
+    get_firm_index()
+    get_version_registry()
+    clear_partitions('analytical')
+    os.makedirs('output/partitions/analytical')
+    stats = map_partitions(prepare_partition, parts)
+    lookups = combine_stats([s[1:] for s in stats])
+    parts = map_partitions(finish_partition, [(s[0], lookups) for s in stats])
+    if split:
+        clear_partitions('balanced')
+
+    # Categorical
+    # The vendors and versions are kept as categoricals with only the values in the dataset,
+    # and the domains are turned back into strings.
+    print("Categorical")
+    nobs = sum(part[2] for part in parts)
+    template = pd.read_pickle(max(parts, key=lambda part: part[2]>0)[0]).iloc[:1].copy()
+    categories = {}
+    for col in ['server_name','server_version']:
+        used = np.logical_or.reduce([part[4][col] for part in parts])
+        categories[col] = template[col].cat.categories[used]
+        template[col] = template[col].cat.set_categories(categories[col])
+    for col in template.columns[template.dtypes==object]:
+        longest = [part[3][col] for part in parts if col in part[3]]
+        template[col] = max(longest, key=len) if len(longest)>0 else np.nan
+
+    def blocks():
+        # The index of the dataset is the row number before firms were filtered out
+        offset = 0
+        for path, n, _, _, _, _ in parts:
+            block = pd.read_pickle(path)
+            block.index += offset
+            offset += n
+            for col in categories:
+                block[col] = block[col].cat.set_categories(categories[col])
+            yield block
+
+    # Export the dataset, one bucket at a time
+    with log_step('export') as step:
+        write_stata_blocks("output/servers_info_panel.dta", template, nobs, blocks(), convert_dates={'dt': 'td'})
+        step.rows_out = nobs
+    write_cube([part[5] for part in parts])
+    clear_partitions('analytical')
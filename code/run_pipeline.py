@@ -0,0 +1,128 @@
+# The following file runs the stages of the pipeline as a graph instead of one after the other.
+# The stages and the files they read and write are listed in PIPELINE_STAGES (in utils).
+# A stage depends on the stages that write its inputs, so stages that don't depend on each other
+# (e.g. encoding the servers and the dates) run at the same time, each in its own process forked
+# from this one. A stage that runs on its own runs in this process. Either way the libraries are
+# only imported once, and the tables that later stages read are shared in memory.
+# A stage is skipped when its script and the contents of its inputs are the same as in the last
+# run and its outputs are still there. The contents are hashed once and then only again when the
+# size or the modification time of a file changes.
+import argparse
+import hashlib
+import json
+import os
+import runpy
+import sys
+import time
+import multiprocessing
+import multiprocessing.connection
+import utils
+from utils import *
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATE_FILE = "output/pipeline_state.json"
+
+# The tables that are passed between stages through write_table and read_table
+TABLES = ['dict_dates','dict_servers','dict_domains','panel_codes','encoded_dates','encoded_servers']
+
+def dependencies(stage):
+    return [other for other in PIPELINE_STAGES if other!=stage and
+        any(path in PIPELINE_STAGES[stage]['inputs'] for path in PIPELINE_STAGES[other]['outputs'])]
+
+def path_digest(path, digests):
+    # The digest of a file, or of all of the files in a directory, reusing the digests of files
+    # whose size and modification time didn't change
+    if os.path.isdir(path):
+        return hashlib.md5("".join(f + path_digest(os.path.join(path, f), digests)
+            for f in sorted(os.listdir(path))).encode("utf8")).hexdigest()
+    stat = os.stat(path)
+    key = [stat.st_size, stat.st_mtime_ns]
+    if digests.get(path, [None])[:2]!=key:
+        digests[path] = key + [file_digest(path)]
+    return digests[path][2]
+
+def stage_hash(stage, digests):
+    # Covers the code of the stage, the inputs and the settings that change the outputs
+    sources = [os.path.join(CODE_DIR, stage + ".py"), os.path.join(CODE_DIR, "utils.py")]
+    settings = json.dumps([PANEL_FORMAT, N_PARTITIONS, MODAL_OBSERVATIONS, AGGREGATE_SNAPSHOTS])
+    return hashlib.md5("".join([settings] + [path_digest(path, digests)
+        for path in sources + PIPELINE_STAGES[stage]['inputs'] if os.path.exists(path)]).encode("utf8")).hexdigest()
+
+def run_stage(stage):
+    # Runs the script of a stage as if it was run on its own. Exiting early with sys.exit() is fine.
+    utils.STAGE = stage
+    start = time.perf_counter()
+    try:
+        runpy.run_path(os.path.join(CODE_DIR, stage + ".py"), run_name='__main__')
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            raise
+    print("Finished %s in %.1fs" % (stage, time.perf_counter() - start))
+
+def fork_stage(stage):
+    process = multiprocessing.get_context('fork').Process(target=run_stage, args=(stage,), name=stage)
+    process.start()
+    return process
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Runs the stages of the pipeline that are out of date.")
+    parser.add_argument("--force", action="store_true", help="run every stage even if its inputs didn't change")
+    args = parser.parse_args()
+
+    os.makedirs("output", exist_ok=True)
+    state = {'stages': {}, 'digests': {}}
+    if os.path.exists(STATE_FILE):
+        with open(STATE_FILE) as f:
+            state = json.load(f)
+    if PANEL_FORMAT=='parquet':
+        utils.SHARED_TABLES = {name: None for name in TABLES}
+
+    pending = list(PIPELINE_STAGES)
+    hashes = {}
+    processes = {}
+    done = set()
+    start = time.perf_counter()
+    while len(pending)>0 or len(processes)>0:
+        # The stages whose dependencies are done are skipped if they are up to date and started otherwise
+        ready = []
+        for stage in [stage for stage in pending if all(other in done for other in dependencies(stage))]:
+            pending.remove(stage)
+            hashes[stage] = stage_hash(stage, state['digests'])
+            if not args.force and state['stages'].get(stage)==hashes[stage] and \
+                all(os.path.exists(path) for path in PIPELINE_STAGES[stage]['outputs']):
+                print("Skipping %s" % stage)
+                done.add(stage)
+            else:
+                ready.append(stage)
+        if len(ready)==0 and len(processes)==0:
+            continue
+
+        # A stage that runs on its own runs in this process, so that the tables it writes are kept in memory.
+        # Stages that can run at the same time each get a forked process.
+        if len(ready)==1 and len(processes)==0:
+            run_stage(ready[0])
+            finished = ready
+        else:
+            for stage in ready:
+                processes[stage] = fork_stage(stage)
+            sentinels = {processes[stage].sentinel: stage for stage in processes}
+            finished = [sentinels[sentinel] for sentinel in multiprocessing.connection.wait(list(sentinels))]
+            for stage in finished:
+                process = processes.pop(stage)
+                process.join()
+                if process.exitcode!=0:
+                    for process in processes.values():
+                        process.join()
+                    sys.exit("%s failed" % stage)
+        for stage in finished:
+            done.add(stage)
+            state['stages'][stage] = hashes[stage]
+        with open(STATE_FILE, "w") as f:
+            json.dump(state, f)
+
+        # Drop the shared tables that no stage still has to read
+        if utils.SHARED_TABLES is not None:
+            for name in TABLES:
+                if all(table_path(name) not in PIPELINE_STAGES[stage]['inputs'] for stage in pending):
+                    utils.SHARED_TABLES[name] = None
+    print("Finished the pipeline in %.1fs" % (time.perf_counter() - start))
@@ -4,9 +4,29 @@ import re
 import tldextract
 import json
 import numpy as np
-from distutils.version import LooseVersion
-from dateutil.relativedelta import relativedelta
 import datetime
+import os
+import hashlib
+import functools
+import inspect
+import pickle
+import pandas.io.stata
+import pandas._libs.parsers
+import gzip
+import shutil
+import sys
+import time
+import cProfile
+import resource
+from multiprocessing import Pool
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.compute as pc
+# orjson parses the raw header data several times faster than json, but it is optional
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 ######################################
 # Constants
@@ -16,6 +36,64 @@ RE_NGINX = re.compile('nginx(?:/([\d.]+))?')
 RE_ISS = re.compile('IIS(?:/([\d.]+))?')
 RE_IPLANET = re.compile('(?:Netscape-Enterprise|Sun-ONE-Web-Server)(?:/([\d.]+( SP[0-9]+)?))?')
 
+# The server vendors in the order in which the header strings are checked for them.
+# The first group of each pattern, if there is one, is the version number.
+SERVER_VENDORS = [
+    ('Apache', RE_APACHE),
+    ('Nginx', RE_NGINX),
+    ('IIS', RE_ISS),
+    ('iPlanet', RE_IPLANET),
+    ('Apache', re.compile('mod_ssl|IBM_HTTP_Server')),
+    ('Nginx', re.compile('Nginx')),
+]
+
+# All of the vendor patterns combined into one regular expression.
+# Each vendor is a lookahead from the start of the string, so the alternation
+# keeps the precedence of the vendors rather than picking the leftmost match.
+RE_SERVER = re.compile('^(?:%s)' % '|'.join(
+    '(?=.*?(?P<vendor%d>%s))' % (i, regex.pattern) for i, (name, regex) in enumerate(SERVER_VENDORS)
+    ), re.DOTALL)
+
+# Number of worker processes used by the parallel stages.
+N_JOBS = int(os.environ.get("N_JOBS", os.cpu_count() or 1))
+
+# Storage format of the intermediate tables that are passed between the stages.
+# "parquet" writes compressed, dictionary encoded columnar files so that each stage
+# only decompresses the columns it reads, "csv" writes gzipped tab delimited files.
+PANEL_FORMAT = os.environ.get("PANEL_FORMAT", "parquet")
+
+# Number of domain buckets that the panel stages are split into.
+# Each bucket is processed on its own, so memory use is bounded by the largest bucket.
+N_PARTITIONS = int(os.environ.get("N_PARTITIONS", 1))
+
+# When set to 1 the stages only redo the work for the inputs that changed since the last run,
+# which is recorded in manifests next to their outputs. Otherwise everything is rebuilt.
+INCREMENTAL = os.environ.get("INCREMENTAL", "0")=="1"
+
+# Set to "cprofile" or "pyinstrument" to profile every logged step of the stages
+# into output/logs/profiles/ (pyinstrument has to be installed for the latter).
+PROFILE = os.environ.get("PROFILE", "")
+
+# When set to 1 the snapshots are aggregated as they are extracted, so that the snapshots of a url
+# with the same server header and date (or month with MODAL_OBSERVATIONS, see aggregate_snapshots)
+# are stored once along with their number. The date headers go down to the second, so this only
+# makes the raw panel noticeably smaller with MODAL_OBSERVATIONS.
+AGGREGATE_SNAPSHOTS = os.environ.get("AGGREGATE_SNAPSHOTS", "0")=="1"
+
+# When set to 1 the observation that is kept for a domain in a month is the modal vendor and version
+# among its snapshots, as the comments in balance_the_panel.py describe. By default it is the first
+# snapshot of the month, as in the code that the published results were made with.
+MODAL_OBSERVATIONS = os.environ.get("MODAL_OBSERVATIONS", "0")=="1"
+
+# The fixed schema of the raw header panel.
+# When the snapshots are aggregated, n is the number of snapshots that each row stands for.
+SERVERS_PANEL_COLUMNS = ['target_url','server','date'] + (['n'] if AGGREGATE_SNAPSHOTS else [])
+
+# The strings that read_csv reads as missing values (e.g. a 'Server: NULL' or 'Server: N/A' header),
+# as the raw header panel was read back from the gzip files. They are missing values in the
+# parquet tables as well, so that both formats give the same panel.
+MISSING_STRINGS = sorted(pandas._libs.parsers.STR_NA_VALUES)
+
 URL_CLEANERS = {
     re.compile('^http(s)?:\/\/(http\/\/)?'): '',
     re.compile('^http(s)?:\/\/[0-9]\.'): '',
@@ -86,6 +164,100 @@ STATE_DICT = {
         'WY': 'Wyoming'
 }
 
+######################################
+# Instrumentation
+######################################
+# The steps of each stage are logged as JSON lines to output/logs/steps.jsonl with the time they took,
+# the rows that went in and out, the memory of the data frame that came out and the memory of the process.
+# The steps of one run of a stage, including the ones run in its worker processes, share the same run id.
+STEP_LOG = "output/logs/steps.jsonl"
+STAGE = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+RUN_ID = "%s-%d" % (datetime.datetime.now().strftime("%Y%m%dT%H%M%S"), os.getpid())
+
+def process_rss():
+    # The current resident memory of this process in MB, where the platform reports it
+    try:
+        with open("/proc/self/statm") as f:
+            return round(int(f.read().split()[1])*os.sysconf("SC_PAGE_SIZE")/2**20, 2)
+    except (OSError, ValueError):
+        return None
+
+class StepLog:
+    # Logs a step of a stage, e.g.
+    #   with log_step('merge versions', df) as step:
+    #       df = pd.merge(df, versions, ...)
+    #       step.output(df)
+    # The rows in and out can also be set directly when the step doesn't work on data frames.
+    profiles = 0
+
+    def __init__(self, name, df=None):
+        self.name = name
+        self.rows_in = len(df) if df is not None else None
+        self.rows_out = None
+        self.frame_mb = None
+        self.frame_mb_deep = None
+
+    def output(self, df):
+        # Measuring the strings of object columns takes about as long as some of the steps,
+        # so the deep size is only measured when the steps are profiled
+        self.rows_out = len(df)
+        if isinstance(df, (pd.DataFrame, pd.Series)):
+            self.frame_mb = round(df.memory_usage(index=True, deep=False).sum()/2**20, 2)
+            if PROFILE:
+                self.frame_mb_deep = round(df.memory_usage(index=True, deep=True).sum()/2**20, 2)
+        return df
+
+    def __enter__(self):
+        self.rss_before = process_rss()
+        self.profiler = None
+        if PROFILE=='cprofile':
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif PROFILE=='pyinstrument':
+            import pyinstrument
+            self.profiler = pyinstrument.Profiler()
+            self.profiler.start()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = time.perf_counter() - self.start
+        if self.profiler is not None:
+            # A step can run more than once in a process, e.g. once for each bucket
+            StepLog.profiles += 1
+            path = "output/logs/profiles/%s.%s.%d.%d" % (STAGE, re.sub('[^A-Za-z0-9]+', '_', self.name), os.getpid(), StepLog.profiles)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if PROFILE=='cprofile':
+                self.profiler.disable()
+                self.profiler.dump_stats(path + ".prof")
+            else:
+                self.profiler.stop()
+                with open(path + ".html", "w") as f:
+                    f.write(self.profiler.output_html())
+        record = {
+            'run': RUN_ID,
+            'stage': STAGE,
+            'step': self.name,
+            'pid': os.getpid(),
+            'seconds': round(self.seconds, 4),
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+            'rows_per_sec': round((self.rows_in or self.rows_out or 0)/max(self.seconds, 1e-9), 1),
+            'frame_mb': self.frame_mb,
+            'frame_mb_deep': self.frame_mb_deep,
+            'rss_mb_before': self.rss_before,
+            'rss_mb': process_rss(),
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024, 2),
+            'failed': exc_type is not None
+        }
+        os.makedirs(os.path.dirname(STEP_LOG), exist_ok=True)
+        # Each line is written in one call so that the lines of the worker processes don't interleave
+        with open(STEP_LOG, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+def log_step(name, df=None):
+    return StepLog(name, df)
+
 ######################################
 # Misc
 ######################################
@@ -93,17 +265,13 @@ def diff_month(d1, d2):
     return (d1.year - d2.year) * 12 + d1.month - d2.month
 
 def clean_version(version):
+    # Versions without a minor version get one, e.g. "2" and "2." become "2.0"
     if version is None or version=="" or pd.isnull(version):
         return np.NaN
-    if isinstance(version, str):
-        version = version.rstrip('.')
-        if '.' not in version:
-            version+=".0"
-    try:
-        v = LooseVersion(version)
-        return str(v)
-    except ValueError:
-        v = np.NaN
+    version = str(version).rstrip('.')
+    if '.' not in version:
+        version+=".0"
+    return version
 
 def extract_domain(url):
     o = url
@@ -116,11 +284,122 @@ def extract_domain(url):
     o=o.rstrip('.')
     return o
 
+######################################
+# Domains
+######################################
+RE_URL_SCHEME = re.compile('^[A-Za-z0-9+.-]+:\/\/|^\/\/')
+RE_IPV4 = re.compile('(?:(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\.){3}(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])')
+
+@functools.lru_cache()
+def get_public_suffixes():
+    # Loads the public suffix list that tldextract.extract uses, so that the domains are the same
+    # as with extract_domain, and splits it into the exact, wildcard and exception rules.
+    # The nodes are every label suffix of a rule, i.e. the nodes of the suffix trie.
+    rules = set()
+    for rule in tldextract.tldextract.TLD_EXTRACTOR.tlds:
+        rules.add(rule)
+        try:
+            rules.add(".".join(label.encode("idna").decode("ascii") for label in rule.split(".")))
+        except UnicodeError:
+            pass
+    suffixes = {
+        'exact': {r for r in rules if not r.startswith('*.') and not r.startswith('!')},
+        'wildcard': {r[2:] for r in rules if r.startswith('*.')},
+        'exception': {r[1:] for r in rules if r.startswith('!')},
+        'nodes': set(),
+        'depth': 0
+    }
+    for rule in suffixes['exact'] | suffixes['wildcard']:
+        labels = rule.split('.')
+        suffixes['depth'] = max(suffixes['depth'], len(labels)+1)
+        for i in range(len(labels)):
+            suffixes['nodes'].add('.'.join(labels[i:]))
+    suffixes['hash'] = hashlib.md5("\n".join(sorted(rules)).encode("utf8")).hexdigest()
+    return suffixes
+
+def normalize_domain_strings(urls):
+    # Vectorized version of extract_domain that runs over the whole column at once with
+    # the arrow string kernels. It follows the same steps, with the host name split into
+    # its registered domain and public suffix by looking up its trailing labels in the
+    # public suffix list.
+    # The urls that the kernels can't handle in exactly the same way as tldextract go through
+    # extract_domain instead: the ones with whitespace or characters outside of ASCII (which arrow
+    # and Python strip and lowercase differently), IPv6 addresses and punycode labels.
+    suffixes = get_public_suffixes()
+    o = pa.array(urls, type=pa.string(), from_pandas=True)
+    exact = pc.fill_null(pc.match_substring_regex(o, '[^!-~]|\\[|[xX][nN]--'), False).to_numpy(zero_copy_only=False)
+    for k,v in URL_CLEANERS.items():
+        o = pc.replace_substring_regex(o, k.pattern, v)
+
+    # The host name of the url
+    host = pc.replace_substring_regex(o, RE_URL_SCHEME.pattern, '')
+    host = pc.replace_substring_regex(host, '(?s)[/?#].*', '')
+    host = pc.replace_substring_regex(host, '(?s)^.*@', '')
+    host = pc.replace_substring_regex(host, '(?s):.*', '')
+    host = pc.utf8_rtrim(pc.utf8_trim_whitespace(host), characters='.')
+
+    # The last k labels of the host name, missing if it has fewer labels than that
+    tails = {}
+    for k in range(1, suffixes['depth']+2):
+        tail = pc.extract_regex(host, '(?P<tail>(?:[^.]*\\.){%d}[^.]*)$' % (k-1))
+        tails[k] = pc.if_else(pc.is_valid(tail), tail.field('tail'), pa.scalar(None, pa.string()))
+
+    def isin(x, values):
+        return pc.fill_null(pc.is_in(pc.utf8_lower(x), value_set=pa.array(list(values), type=pa.string())), False).to_numpy(zero_copy_only=False)
+
+    # Walk up the labels from the right for as long as they are in the suffix trie
+    # and keep the longest one that is a public suffix.
+    # Wildcard rules match any label where the walk stops, unless there is an exception rule for it.
+    suffix_len = np.zeros(len(host), dtype=int)
+    walking = np.ones(len(host), dtype=bool)
+    for k in range(1, suffixes['depth']+1):
+        in_trie = isin(tails[k], suffixes['nodes'])
+        if k>1:
+            exists = pc.is_valid(tails[k]).to_numpy(zero_copy_only=False)
+            wildcard = walking & exists & ~in_trie & isin(tails[k-1], suffixes['wildcard'])
+            exception = wildcard & isin(tails[k], suffixes['exception'])
+            suffix_len[wildcard & ~exception] = k
+            suffix_len[exception] = k-1
+        walking = walking & in_trie
+        suffix_len[walking & isin(tails[k], suffixes['exact'])] = k
+
+    # The registered domain is the public suffix and the label before it.
+    # Hosts without a public suffix keep their last label, or the whole host if it is an ip address.
+    ip = pc.match_substring_regex(host, '^%s$' % RE_IPV4.pattern)
+    o = pc.binary_join_element_wise(pc.if_else(ip, host, tails[1]), '.', '')
+    for k in range(1, suffixes['depth']+1):
+        registered = pc.coalesce(tails[k+1], pc.binary_join_element_wise('.', tails[k], ''))
+        o = pc.if_else(pa.array(suffix_len==k), registered, o)
+
+    # regular expressions to match and replace to clean url
+    o = pc.replace_substring_regex(o, '(?s)^.*@', '')
+    o = pc.replace_substring_regex(o, '(?s):80.*', '')
+    for v in ['%ef%bb%bf','%c2%ad','http://.','http://www3.','http://www2.','https://www.','http://www.','https://','http//']:
+        o = pc.replace_substring(o, v, '')
+    o = pc.utf8_ltrim(pc.utf8_rtrim(o, characters='/'), characters='.')
+    o = pc.utf8_rtrim(o, characters='.')
+    domains = o.to_pandas().values
+    domains[exact] = [extract_domain(url) for url in urls.values[exact]]
+    return pd.DataFrame({'domain': domains}, index=urls.index)
+
+def normalize_domains(urls):
+    # Cleans the target urls into domains, reusing the results for the urls that have been seen before.
+    # The urls that normalize_domain_strings can't handle go through extract_domain, so its code is part of the rules.
+    rules = "\n".join(["%s -> %s" % (k.pattern, v) for k, v in URL_CLEANERS.items()] +
+        [get_public_suffixes()['hash'], inspect.getsource(extract_domain)])
+    return cached_lookup(urls, 'domains', rules, normalize_domain_strings)['domain']
+
 
 ######################################
 # Versions
 ######################################
-def get_version_df():
+VERSION_FILES = [
+    "input/versions_with_dates.xlsx",
+    "input/apache_begin_avails.txt",
+    "input/nginx_begin_avails.txt"
+    ]
+
+def read_version_files():
     versions = pd.read_excel("input/versions_with_dates.xlsx")
     versions['begin_avail'] = pd.to_datetime(versions['begin_avail'])
     versions = versions.sort_values("begin_avail")
@@ -153,82 +432,693 @@ def get_version_df():
 
     return versions
 
+class VersionRegistry:
+    # The dates on which each version of the server software became available.
+    # Reading the spreadsheet is slow, so the compiled registry is pickled in output/cache/
+    # under a hash of the input files and of the code that reads them, and every stage
+    # after the first one just loads that. The pickle is written next to its path and moved
+    # there when it is complete, so that stages that run at the same time never read half of it.
+    def __init__(self, versions):
+        self.df = versions
+        # The begin_avail of each (vendor, version)
+        self.begin_avail = dict(zip(zip(versions['name'], versions['version'].astype(str)), versions['begin_avail']))
+        # The versions of each vendor sorted by when they became available
+        self.vendors = {}
+        for name, group in versions.sort_values('begin_avail', kind='mergesort').groupby('name'):
+            self.vendors[name] = {
+                'begin_avail': group['begin_avail'].values,
+                'version': group['version'].values
+                }
+
+    def begin_avail_table(self):
+        # The begin_avail of each (vendor, version) as a table to merge on
+        return pd.DataFrame([(name, version, begin_avail) for (name, version), begin_avail in self.begin_avail.items()],
+            columns=['server_name','version_clean','begin_avail'])
+
+    def lookup(self, name, version):
+        return self.begin_avail.get((name, str(version)), np.NaN)
+
+    @classmethod
+    def load(cls):
+        rules = "".join(file_digest(path) for path in VERSION_FILES)
+        rules += inspect.getsource(read_version_files) + inspect.getsource(clean_version) + inspect.getsource(cls)
+        path = "output/cache/versions_%s.pkl" % hashlib.md5(rules.encode("utf8")).hexdigest()[:12]
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                return pickle.load(f)
+        registry = cls(read_version_files())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open("%s.%d.tmp" % (path, os.getpid()), "wb") as f:
+            pickle.dump(registry, f)
+        os.replace("%s.%d.tmp" % (path, os.getpid()), path)
+        return registry
+
+@functools.lru_cache()
+def get_version_registry():
+    return VersionRegistry.load()
+
+def get_version_df():
+    return get_version_registry().df.copy()
+
 def get_version_dict():
-    versions = get_version_df()
     versions_dict = {}
-    for row in versions.iterrows():
-        if row[1]['name'] not in versions_dict:
-            versions_dict[row[1]['name']] = {}
-        versions_dict[row[1]['name']][str(row[1]['version'])]=row[1]['begin_avail']
+    for (name, version), begin_avail in get_version_registry().begin_avail.items():
+        versions_dict.setdefault(name, {})[version] = begin_avail
     return versions_dict
 
-def find_version_begin_avail(row,versions_dict):
-    if row['server_name'] in versions_dict:
-        return versions_dict.get(row['server_name']).get(str(row['version_clean']))
-    return np.NaN
-
-
-def get_lastest_versions_avail():
-    versions = get_version_df()
-    versions = versions.sort_values(['begin_avail'])
-    # Setup all of the months
-    months = []
-    end = datetime.datetime(2019, 1, 1)
-    current = datetime.datetime(2000, 1, 1)
-    while current <= end:
-        months.append(current)
-        current += relativedelta(months=1)
-    # Find the lastest version for each
-    df = []
-    for month in months:
-    	output = {'month': month}
-    	avail_versions = versions.loc[(versions['begin_avail']<=month)]
-    	for server_vendor in ("Apache","IIS","iPlanet","Nginx"):
-    		vendor_avail = avail_versions.loc[avail_versions['name']==server_vendor]
-    		if len(vendor_avail)>0:
-    			last_vendor_version_avail = vendor_avail.iloc[-1]['begin_avail']
-    			output[server_vendor] = diff_month(month,last_vendor_version_avail)
-    			output["latest_" + server_vendor.lower() + "_begin_avail_dm"] = last_vendor_version_avail.strftime("%Y-%m")
-    	df.append(output)
-
-    df = pd.DataFrame(df)
-    df.rename(columns={
-        "Apache": 'latest_apache',
-        "IIS": 'latest_iis',
-        "iPlanet": 'latest_iplanet',
-        "Nginx": 'latest_nginx'
-        }, inplace=True)
-    df['month'] = pd.to_datetime(df['month'])
-    df['dm'] = df['month'].dt.strftime("%Y%m")
-    df['dm'] = pd.to_numeric(df['dm'])
-    del df['month']
+
+def get_dates(start, end, freq):
+    dates = pd.date_range(start, end, freq=freq)
+    return pd.DataFrame({'dt': dates, 'dm': dates.year*100 + dates.month})
+
+def get_lastest_versions_avail(start="2000-01-01", end="2019-01-01", freq="MS",
+    vendors=("Apache","IIS","iPlanet","Nginx")):
+    # For each date, the number of months since the latest version of each vendor became available
+    # and the month in which it did, using the vendor's versions sorted by when they became available.
+    registry = get_version_registry()
+    df = get_dates(start, end, freq)
+    dates = df['dt'].values
+    for server_vendor in vendors:
+        begin_avail = registry.vendors[server_vendor]['begin_avail']
+        begin_avail = begin_avail[~np.isnat(begin_avail)]
+        i = np.searchsorted(begin_avail, dates, side='right') - 1
+        last_vendor_version_avail = pd.Series(begin_avail).reindex(i).reset_index(drop=True)
+        df["latest_" + server_vendor.lower()] = \
+            (df['dt'].dt.year - last_vendor_version_avail.dt.year)*12 + df['dt'].dt.month - last_vendor_version_avail.dt.month
+        df["latest_" + server_vendor.lower() + "_begin_avail_dm"] = last_vendor_version_avail.dt.strftime("%Y-%m")
     return df
 
-def get_closest_iis():
-    versions = get_version_df()
-    versions = versions.sort_values(['begin_avail'])
-    iis_versions = versions.loc[versions['name']=='IIS']
-    # Setup all of the months
-    months = []
-    end = datetime.datetime(2019, 1, 1)
-    current = datetime.datetime(2000, 1, 1)
-    while (current <= end):
-        months.append(current)
-        current += relativedelta(months=1)
-    df = []
-    for month in months:
-        output = {
-            'month': month
-            }
-        tmp = iis_versions.iloc[(iis_versions['begin_avail']-month).abs().argsort()[:1]]
-        if len(tmp)>0:
-            output['iis_nearest_version'] = tmp.iloc[0]['version']
-            df.append(output)
-    df = pd.DataFrame(df)
-    df['month'] = pd.to_datetime(df['month'])
-    df['dm'] = df['month'].dt.strftime("%Y%m")
-    df['dm'] = pd.to_numeric(df['dm'])
-    del df['month']
+def get_closest_versions(server_vendor, start="2000-01-01", end="2019-01-01", freq="MS"):
+    # For each date, the version of the vendor that became available closest to it.
+    # Versions that became available on the same day go to the last one of them in version order.
+    versions = get_version_registry().vendors[server_vendor]
+    begin_avail = versions['begin_avail'][~np.isnat(versions['begin_avail'])]
+    version = versions['version'][~np.isnat(versions['begin_avail'])]
+    df = get_dates(start, end, freq)
+    dates = df['dt'].values
+    if len(begin_avail)==0:
+        df[server_vendor.lower() + '_nearest_version'] = np.NaN
+        return df
+    right = np.searchsorted(begin_avail, dates, side='left').clip(max=len(begin_avail)-1)
+    left = (right - 1).clip(min=0)
+    closest = np.where(np.abs(begin_avail[left]-dates) <= np.abs(begin_avail[right]-dates), left, right)
+    closest = np.searchsorted(begin_avail, begin_avail[closest], side='right') - 1
+    df[server_vendor.lower() + '_nearest_version'] = version[closest]
+    return df
+
+def get_closest_iis(start="2000-01-01", end="2019-01-01", freq="MS"):
+    return get_closest_versions('IIS', start, end, freq)
+
+######################################
+# Firm Information
+######################################
+FIRM_FILES = [
+    "input/orbis_location.txt.gz",
+    "input/orbis_naics.txt.gz",
+    "input/compustat_static.txt.gz"
+    ]
+
+def firm_attributes(domains):
+    # The state and NAICS codes of each domain. The Compustat data is used where it has them
+    # and the Orbis data otherwise. Domains that are listed more than once get their first listing.
+    orbis = pd.read_csv("input/orbis_location.txt.gz", sep="\t", compression='gzip',
+        usecols=['domain','state_us'])
+    orbis.rename(columns={'state_us':'orbis_state'}, inplace=True)
+    df = orbis.drop_duplicates('domain').set_index('domain').reindex(domains.values)
+
+    orbis = pd.read_csv("input/orbis_naics.txt.gz", sep="\t", compression='gzip',
+        usecols=['domain','naics','naicsccod2017'])
+    orbis.rename(columns={'naics': 'orbis_naics', 'naicsccod2017': 'orbis_naics6'}, inplace=True)
+    df = df.join(orbis.drop_duplicates('domain').set_index('domain'))
+
+    compustat = pd.read_csv("input/compustat_static.txt.gz", sep="\t", compression='gzip',
+        usecols=['domain','state','naics','naics6'])
+    compustat.rename(columns={'state':'compustat_state', 'naics': 'compustat_naics', 'naics6': 'compustat_naics6'}, inplace=True)
+    df = df.join(compustat.drop_duplicates('domain').set_index('domain'))
+
+    # Combine Orbis and Compustat variables
+    for variable in ['naics','naics6','state']:
+        df[variable] = np.NaN
+        df.loc[df[variable].isnull(),variable] = df['compustat_'+variable]
+        df.loc[df[variable].isnull(),variable] = df['orbis_'+variable]
+    return df[['state','naics','naics6']].set_index(domains.index)
+
+@functools.lru_cache()
+def get_firm_index():
+    # The firm attributes of every domain in the dictionary of domains, by domain_id.
+    # They are cached on disk under a hash of the input files, so the Orbis and Compustat
+    # files are only read again when they change or when there are new domains.
+    domains = read_table('dict_domains')['domain']
+    rules = "".join(file_digest(path) for path in FIRM_FILES) + inspect.getsource(firm_attributes)
+    firms = cached_lookup(domains, 'firms', rules, firm_attributes)
+    return pd.Index(domains), firms.reset_index(drop=True)
+
+def get_firm_info(domains):
+    # Looks up the firm attributes of a column of domains through their domain_id.
+    index, firms = get_firm_index()
+    codes, uniques = pd.factorize(domains)
+    domain_id = np.where(codes>=0, index.get_indexer(uniques)[codes], -1)
+    return firms.reindex(domain_id).set_index(domains.index)
+
+######################################
+# Intermediate Tables
+######################################
+# When the stages are run by run_pipeline.py, the tables that later stages read are also kept in
+# memory as Arrow tables, which is what the parquet files are decoded into. The stages that run in
+# the same process, or in processes forked from it, then read them without going through the disk.
+# The pipeline sets this to a dict with the names of the tables that are shared.
+SHARED_TABLES = None
+
+def table_path(name):
+    if PANEL_FORMAT=='parquet':
+        return "output/%s.parquet" % name
+    return "output/%s.txt.gz" % name
+
+def read_table(name, columns=None):
+    if SHARED_TABLES is not None and SHARED_TABLES.get(name) is not None:
+        table = SHARED_TABLES[name]
+        return (table.select(columns) if columns is not None else table).to_pandas()
+    # The parquet tables can be either a single file or a directory of part files.
+    if PANEL_FORMAT=='parquet':
+        return pd.read_parquet(table_path(name), columns=columns)
+    return pd.read_csv(table_path(name), sep="\t", compression='gzip', usecols=columns)
+
+def write_table(df, name):
+    os.makedirs(os.path.dirname(table_path(name)), exist_ok=True)
+    if SHARED_TABLES is not None and name in SHARED_TABLES:
+        SHARED_TABLES[name] = pa.Table.from_pandas(df, preserve_index=False)
+    if PANEL_FORMAT=='parquet':
+        df.to_parquet(table_path(name), index=False, compression='zstd')
+    else:
+        df.to_csv(table_path(name), sep="\t", compression='gzip', index=False)
+
+def cached_lookup(keys, name, rules, compute):
+    # Looks up the results for a column of string keys in a table cached on disk.
+    # Only the unique keys that are not in the cache yet are passed to compute, which returns
+    # a data frame of results for them. The cache is named after a hash of the rules that
+    # produce the results, so that it is rebuilt from scratch whenever those change.
+    # The hash also covers the columns of the cache and the code of compute,
+    # so that a cache with another layout is never read.
+    rules = "\n".join(['key', rules, inspect.getsource(compute)])
+    cache_name = "cache/%s_%s" % (name, hashlib.md5(rules.encode("utf8")).hexdigest()[:12])
+    if os.path.exists(table_path(cache_name)):
+        cache = read_table(cache_name)
+    else:
+        cache = None
+
+    seen = cache['key'] if cache is not None else pd.Series([], dtype=object)
+    unseen = keys.loc[keys.notnull() & ~keys.isin(seen)].drop_duplicates()
+    if len(unseen)>0:
+        computed = compute(unseen)
+        computed.insert(0, 'key', unseen)
+        cache = pd.concat([cache, computed], axis=0, ignore_index=True)
+        write_table(cache, cache_name)
+    if cache is None:
+        cache = compute(keys.iloc[:0])
+        cache.insert(0, 'key', keys.iloc[:0])
+
+    # Missing keys and keys that are not in the cache get missing results.
+    return cache.set_index('key').reindex(keys.values).set_index(keys.index)
+
+def mask_missing_strings(df):
+    return df.mask(df.isin(MISSING_STRINGS))
+
+class TablePartWriter:
+    # Writes one part of a table in batches of rows with a fixed set of string columns,
+    # apart from the snapshot counts in n. The batches are lists of rows or data frames.
+    # Parquet parts get one row group per batch. The gzip parts are written without a
+    # header so that they can be concatenated into a single file afterwards.
+    def __init__(self, path, columns):
+        self.columns = columns
+        if PANEL_FORMAT=='parquet':
+            self.schema = pa.schema([(c, pa.int64() if c=='n' else pa.string()) for c in columns])
+            self.writer = pq.ParquetWriter(path, self.schema, compression='zstd')
+        else:
+            self.writer = gzip.open(path, "wt")
+
+    def write(self, rows):
+        if len(rows)==0:
+            return
+        batch = pd.DataFrame(rows, columns=self.columns)
+        if PANEL_FORMAT=='parquet':
+            # The strings that read_csv takes for missing values are missing values,
+            # the same as when they are read back from the gzip files.
+            strings = [c for c in self.columns if c!='n']
+            batch[strings] = mask_missing_strings(batch[strings])
+            self.writer.write_table(pa.Table.from_pandas(batch, schema=self.schema, preserve_index=False))
+        else:
+            batch.to_csv(self.writer, sep="\t", index=False, header=False)
+
+    def close(self):
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+######################################
+# Codes
+######################################
+# The domains and the server vendors and versions are carried through the panel as integer codes
+# into sorted dictionaries of their values, i.e. as categoricals, and only turned back into strings
+# when the data is exported. Since the dictionaries are sorted, sorting by the codes is the same as
+# sorting by the strings. The domain codes are the domain_id of the dictionary of domains.
+CODED_COLUMNS = ['domain','server_name','server_version']
+
+@functools.lru_cache()
+def get_dictionary(name):
+    if name=='domain':
+        return pd.Index(read_table('dict_domains')['domain'])
+    # Empty strings are missing values
+    values = read_table('encoded_servers', columns=[name])[name].replace('', np.NaN).dropna()
+    return pd.Index(np.sort(values.unique()))
+
+def from_codes(codes, name):
+    # The missing code -1 is a missing value
+    return pd.Categorical.from_codes(codes, categories=get_dictionary(name))
+
+def encode(values, name):
+    # Codes a column of strings, or recodes a categorical, into the dictionary of its values
+    return pd.Categorical(values, categories=get_dictionary(name))
+
+def decode(values):
+    return np.asarray(values, dtype=object)
+
+def get_server_codes():
+    # The vendor and version codes of each server_id
+    servers = read_table('encoded_servers', columns=['server_id','server_name','server_version'])
+    codes = pd.DataFrame({'server_id': servers['server_id']})
+    for col in ['server_name','server_version']:
+        codes[col] = get_dictionary(col).get_indexer(servers[col])
+    return codes
+
+######################################
+# Exporting
+######################################
+class HDFTableWriter:
+    # Writes a data frame to a compressed HDF5 table in blocks of rows, indexed on the given columns
+    # so that slices can be read with e.g. pd.read_hdf(path, 'df', where='domain=="example.com"').
+    # The table is written next to the path and moved there when it is closed,
+    # so the old file can be read while the new one is being written.
+    def __init__(self, path, data_columns, key='df'):
+        self.path = path
+        self.key = key
+        self.data_columns = data_columns
+        self.nrows = 0
+        self.store = pd.HDFStore(path + ".tmp", mode='w', complevel=5, complib='blosc:zstd')
+
+    def append(self, df):
+        if len(df)==0:
+            return
+        df = df.set_axis(pd.RangeIndex(self.nrows, self.nrows+len(df)), axis=0)
+        self.store.append(self.key, df, format='table', data_columns=self.data_columns, index=False)
+        self.nrows += len(df)
+
+    def close(self):
+        if self.key in self.store:
+            self.store.create_table_index(self.key, columns=self.data_columns, optlevel=9, kind='full')
+        self.store.close()
+        os.replace(self.path + ".tmp", self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# StataBlockWriter works through the internals of pandas' StataWriter, which change between releases,
+# so it is only used with the versions of pandas that it was checked against.
+STATA_BLOCK_PANDAS = ['1.5']
+
+class StataBlockWriter(pandas.io.stata.StataWriter):
+    # Writes a Stata file from blocks of rows, so that only one block has to be in memory.
+    # The header is made from a template with the final types of the columns: the longest string
+    # of each string column and the categories of each categorical. Every block is then converted
+    # in the same way as to_stata does and checked against the header, and the value labels are
+    # written after the data as usual.
+    def __init__(self, fname, template, nobs, convert_dates=None, **kwargs):
+        if ".".join(pd.__version__.split(".")[:2]) not in STATA_BLOCK_PANDAS:
+            raise RuntimeError("StataBlockWriter has not been checked with pandas %s" % pd.__version__)
+        self.block_convert_dates = dict(convert_dates or {})
+        super().__init__(fname, template, convert_dates=dict(self.block_convert_dates), **kwargs)
+        self.header = (self.typlist, self.fmtlist, self._value_labels, self._has_value_labels)
+        self.nobs = nobs
+
+    def _prepare_block(self, block):
+        typlist, fmtlist, value_labels, has_value_labels = self.header
+        self._value_labels = []
+        self._convert_dates = dict(self.block_convert_dates)
+        # Missing strings are written as empty strings either way
+        for col in block.columns[block.dtypes==object]:
+            block[col] = block[col].fillna("")
+        self._prepare_pandas(block)
+        for col, typ, block_typ in zip(self.varlist, typlist, self.typlist):
+            if block_typ!=typ and not (typ<=self._max_string_length and block_typ<=typ):
+                raise ValueError("Column %s does not have the same type as in the template" % col)
+        self.typlist, self.fmtlist = typlist, fmtlist
+        records = self._prepare_data()
+        self._value_labels, self._has_value_labels = value_labels, has_value_labels
+        return records
+
+    def write_blocks(self, blocks):
+        nobs = self.nobs
+        with pandas.io.common.get_handle(self._fname, "wb", is_text=False) as self.handles:
+            self._write_header(data_label=self._data_label, time_stamp=self._time_stamp)
+            self._write_map()
+            self._write_variable_types()
+            self._write_varnames()
+            self._write_sortlist()
+            self._write_formats()
+            self._write_value_label_names()
+            self._write_variable_labels()
+            self._write_expansion_fields()
+            self._write_characteristics()
+            n = 0
+            for block in blocks:
+                # The categoricals of an empty block can't be converted, and it has nothing to write anyway
+                if len(block)==0:
+                    continue
+                records = self._prepare_block(block)
+                self._write_data(records)
+                n += len(records)
+            if n!=nobs:
+                raise ValueError("Wrote %d rows instead of %d" % (n, nobs))
+            self._write_strls()
+            self._write_value_labels()
+            self._write_file_close_tag()
+            self._write_map()
+            self._close()
+
+def write_stata_blocks(fname, template, nobs, blocks, convert_dates=None):
+    # Writes the blocks to a Stata file one at a time where StataBlockWriter can be used,
+    # and otherwise all at once with to_stata
+    if nobs>0 and ".".join(pd.__version__.split(".")[:2]) in STATA_BLOCK_PANDAS:
+        StataBlockWriter(fname, template, nobs, convert_dates=convert_dates).write_blocks(blocks)
+    else:
+        pd.concat(list(blocks), axis=0).to_stata(fname, convert_dates=convert_dates)
+
+######################################
+# Market Share Cube
+######################################
+# The analytical panel summed up by vendor, version, month, state and NAICS code: the number of
+# domain months in each cell and their SUSB weights, in total and split by whether they were
+# observed or interpolated. Missing vendors, versions, states and NAICS codes are cells of their own.
+CUBE_DIMENSIONS = ['server_name','server_version','dt','yr','state','naics']
+CUBE_MEASURES = ['n','n_observed','n_interpolated','weight','weight_observed','weight_interpolated']
+
+def cube_cells(df):
+    # Sums up the rows of a domain bucket of the analytical panel into the cells of the cube.
+    # The cells are on the codes of the vendors and versions, so the buckets can be summed up together.
+    # The observed and interpolated rows are summed up side by side, which also works for an empty bucket
+    interpolated = df['interpolated'].values>0
+    weight = df['susb_weights'].values
+    cells = pd.DataFrame({
+        'server_name': df['server_name'].cat.codes.values,
+        'server_version': df['server_version'].cat.codes.values,
+        'month': month_code(df['dt']),
+        'state': df['state'].fillna('').values,
+        'naics': df['naics'].fillna(-1).values.astype('int64'),
+        'n_observed': (~interpolated).astype('int64'),
+        'n_interpolated': interpolated.astype('int64'),
+        'weight_observed': np.where(interpolated, 0, weight),
+        'weight_interpolated': np.where(interpolated, weight, 0)
+        })
+    cells = cells.groupby(['server_name','server_version','month','state','naics']).sum()
+    cells['n'] = cells['n_observed'] + cells['n_interpolated']
+    cells['weight'] = cells['weight_observed'] + cells['weight_interpolated']
+    return cells
+
+def write_cube(cells, path="output/market_share_cube.parquet"):
+    # Sums up the cells of the buckets and writes the cube as a parquet file,
+    # with the vendors, versions and states dictionary encoded
+    cube = pd.concat(cells, axis=0).groupby(level=[0,1,2,3,4]).sum().reset_index()
+    cube = pd.DataFrame({
+        'server_name': from_codes(cube['server_name'].values, 'server_name'),
+        'server_version': from_codes(cube['server_version'].values, 'server_version'),
+        'dt': month_start(cube['month'].values),
+        'yr': (cube['month'].values//12).astype('int16'),
+        'state': pd.Categorical(cube['state'].replace('', np.NaN)),
+        'naics': cube['naics'].where(cube['naics']>=0).astype('Int16').values,
+        **{measure: cube[measure].values for measure in CUBE_MEASURES}
+        })
+    for col in ['server_name','server_version']:
+        cube[col] = cube[col].cat.remove_unused_categories()
+    cube[CUBE_MEASURES[:3]] = cube[CUBE_MEASURES[:3]].astype('int64')
+    cube.to_parquet(path, index=False, compression='zstd')
+
+def read_cube(path="output/market_share_cube.parquet"):
+    return pd.read_parquet(path)
+
+def cube_query(cube, by, share_within=None, **where):
+    # Rolls the cube up to the dimensions in by, after keeping the cells where each dimension
+    # in where has the given value or one of the given values, e.g.
+    #   cube_query(cube, ['yr','server_name'], share_within=['yr'], state=['CA','NY'], yr=range(2005, 2010))
+    # gives the number of domain months of each vendor in California and New York in each year from
+    # 2005 to 2009. With share_within the shares of the counts and the weights within each group of
+    # those dimensions are added as well, e.g. the market share of each vendor in each year.
+    keep = np.ones(len(cube), dtype=bool)
+    for dim, values in where.items():
+        values = [values] if isinstance(values, str) or not np.iterable(values) else list(values)
+        keep &= cube[dim].isin(values).values
+    cube = cube.loc[keep]
+    # Missing values are groups of their own, which is only reliable on object columns here
+    keys = [cube[dim].astype(object) if cube[dim].dtype.name=='category' else cube[dim] for dim in by]
+    result = cube.groupby(keys, dropna=False)[CUBE_MEASURES].sum()
+    if share_within is not None:
+        for measure in ['n','weight']:
+            total = result[measure].groupby(level=share_within, dropna=False).transform('sum')
+            result[measure + '_share'] = result[measure]/total
+    return result
+
+######################################
+# Panel Store
+######################################
+# The balanced panel as a directory of numpy arrays that are opened as memory maps, so the server
+# history of a single domain is read without loading the panel. The rows are sorted by domain and
+# month and each column is a fixed width array of codes: the month (as in month_code), the codes of
+# the vendor and the version into their dictionaries (-1 is missing) and whether it was interpolated.
+# The rows of each domain are at offsets[domain_id]:offsets[domain_id+1], where domain_id is the
+# position of the domain in the sorted dictionary of domains, which is stored as UTF-8 bytes.
+PANEL_STORE = "output/servers_panel_store"
+PANEL_STORE_COLUMNS = {'month': 'int32', 'server_name': 'int16', 'server_version': 'int32', 'interpolated': 'int8'}
+
+def string_dictionary(values):
+    # Fixed width UTF-8 bytes, which sort in the same order as the strings
+    return np.array([value.encode("utf8") for value in values], dtype='S') if len(values)>0 else np.array([], dtype='S1')
+
+class PanelStore:
+    # Reads the server histories of single domains from the panel store, e.g.
+    #   PanelStore().history('example.com')
+    def __init__(self, path=PANEL_STORE):
+        self.arrays = {col: np.load(os.path.join(path, col + ".npy"), mmap_mode='r') for col in PANEL_STORE_COLUMNS}
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode='r')
+        self.domains = np.load(os.path.join(path, "domains.npy"), mmap_mode='r')
+        self.categories = {col: pd.Index(np.char.decode(np.load(os.path.join(path, col + "_dictionary.npy")), "utf8"))
+            for col in ['server_name','server_version']}
+
+    def domain_id(self, domain):
+        # The position of a domain in the dictionary, or -1 if it is not in the panel
+        key = domain.encode("utf8")
+        i = int(np.searchsorted(self.domains, key))
+        return i if i<len(self.domains) and self.domains[i]==key else -1
+
+    def codes(self, domain):
+        # The rows of a domain as views into the memory maps, without copying them
+        i = self.domain_id(domain)
+        start, end = (self.offsets[i], self.offsets[i+1]) if i>=0 else (0, 0)
+        return {col: array[start:end] for col, array in self.arrays.items()}
+
+    def history(self, domain):
+        # The rows of a domain in the same form as in the balanced panel
+        codes = self.codes(domain)
+        return pd.DataFrame({
+            'domain': domain,
+            'dt': month_start(codes['month']),
+            'server_name': pd.Categorical.from_codes(codes['server_name'], self.categories['server_name']),
+            'server_version': pd.Categorical.from_codes(codes['server_version'], self.categories['server_version']),
+            'interpolated': codes['interpolated'].astype(float)
+            })
+
+######################################
+# Pipeline Stages
+######################################
+# The stages in the order of the Makefile, with the files that each one reads and writes.
+# The pipeline runner and the benchmark both use these; the Makefile lists the same files.
+# 'source' is the output of an earlier stage that the stage mostly reads (None for the raw inputs),
+# so that the benchmark can count the rows that went in, and the first output is the one it counts as out.
+PIPELINE_STAGES = {
+    'extract_cookie_data': {
+        'inputs': ["input/ia/kenji/archive.org/~kenji/wayback-response-headers", "input/extract_from_api/outputs/header.jl"],
+        'outputs': [table_path('servers_panel')],
+        'source': None},
+    'build_dictionaries': {
+        'inputs': [table_path('servers_panel')],
+        'outputs': [table_path(name) for name in ['panel_codes','dict_dates','dict_servers','dict_domains']],
+        'source': table_path('servers_panel')},
+    'encode_servers': {
+        'inputs': [table_path('dict_servers')] + VERSION_FILES,
+        'outputs': [table_path('encoded_servers')],
+        'source': table_path('panel_codes')},
+    'encode_dates': {
+        'inputs': [table_path(name) for name in ['dict_dates','panel_codes']],
+        'outputs': [table_path('encoded_dates')],
+        'source': table_path('panel_codes')},
+    'balance_the_panel': {
+        'inputs': [table_path(name) for name in ['panel_codes','dict_domains','encoded_dates','encoded_servers']],
+        'outputs': ["output/servers_panel_semibalanced.h5", table_path('servers_panel_semibalanced_digests'),
+            table_path('servers_panel_events')],
+        'source': table_path('panel_codes')},
+    'prepare_analytical_dataset': {
+        'inputs': ["output/servers_panel_semibalanced.h5", table_path('dict_domains'), table_path('encoded_servers'),
+            "input/iis_prices.xlsx", "input/cpi.txt.gz", "input/susb_naics_weights.txt"] + VERSION_FILES + FIRM_FILES,
+        'outputs': ["output/servers_info_panel.dta", "output/market_share_cube.parquet"],
+        'source': "output/servers_panel_semibalanced.h5"},
+    'build_panel_store': {
+        'inputs': ["output/servers_panel_semibalanced.h5", table_path('dict_domains'), table_path('encoded_servers')],
+        'outputs': [PANEL_STORE + "/offsets.npy"],
+        'source': "output/servers_panel_semibalanced.h5"},
+}
+
+######################################
+# Partitions
+######################################
+def domain_buckets(domain_id):
+    # Assigns each domain to one of N_PARTITIONS buckets of consecutive domains.
+    # The domain codes are sorted, so the buckets are in order of the domains as well and
+    # the panel can be written out bucket by bucket.
+    return np.asarray(domain_id).astype('int64')*N_PARTITIONS // max(len(get_dictionary('domain')), 1)
+
+def map_partitions(f, tasks):
+    # Runs f on every task, in the worker processes if there is more than one task
+    if len(tasks)>1 and N_JOBS>1:
+        with Pool(N_JOBS) as pool:
+            return pool.map(f, tasks)
+    return [f(task) for task in tasks]
+
+def clear_partitions(name):
+    path = "output/partitions/%s" % name
+    if os.path.exists(path):
+        shutil.rmtree(path)
+
+def write_partitions(df, buckets, name):
+    # Splits a table into one table per bucket under output/partitions/<name>
+    # and returns the names of the parts in bucket order.
+    clear_partitions(name)
+    parts = []
+    for bucket in range(N_PARTITIONS):
+        part = "partitions/%s/part_%03d" % (name, bucket)
+        write_table(df.loc[buckets==bucket], part)
+        parts.append(part)
+    return parts
+
+def list_partitions(name):
+    # Returns the paths of the part files under output/partitions/<name> in bucket order.
+    path = "output/partitions/%s" % name
+    if not os.path.exists(path):
+        return []
+    return sorted(os.path.join(path, f) for f in os.listdir(path))
+
+######################################
+# Incremental Updates
+######################################
+def file_digest(path):
+    h = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1<<20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def read_manifest(name):
+    # Returns the manifest of the last run of a stage, or None if it should start from scratch.
+    path = "output/%s_manifest.json" % name
+    if not INCREMENTAL or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def write_manifest(name, manifest):
+    with open("output/%s_manifest.json" % name, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+def code_hashes(values):
+    # Hashes of the entries of a dictionary of codes, with the hash of the missing code -1 at the end.
+    return np.append(pd.util.hash_pandas_object(pd.Series(values), index=False).values, np.uint64(0))
+
+def domain_digests(domain_id, row_hashes):
+    # Combines the hashes of the rows of each domain, in the order that the rows are in,
+    # into one digest per domain. Two domains have the same digest when they have the same
+    # rows in the same order, regardless of what the other domains look like.
+    if len(domain_id)==0:
+        return pd.Series([], dtype='int64')
+    order = np.argsort(domain_id, kind='stable')
+    domain_id = np.asarray(domain_id)[order]
+    starts = np.flatnonzero(np.append(True, domain_id[1:]!=domain_id[:-1]))
+    rank = np.arange(len(order)) - np.repeat(starts, np.diff(np.append(starts, len(order))))
+    h = pd.util.hash_array(np.asarray(row_hashes)[order] + rank.astype('uint64')*np.uint64(0x9E3779B97F4A7C15))
+    return pd.Series(np.bitwise_xor.reduceat(h, starts).view('int64'), index=domain_id[starts])
+
+######################################
+# Extracting Headers
+######################################
+def loads_snapshot(crawl):
+    # Parses one line of the raw header data, as bytes or a string. The few lines that orjson is stricter
+    # about than json (e.g. escaped lone surrogates or NaN values) are parsed by json as before.
+    if orjson is not None:
+        try:
+            return orjson.loads(crawl)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(crawl)
+
+def parse_snapshot(crawl):
+    # Extract the URI that was targeted by the Internet Archive along with the
+    # server and date headers from one snapshot of the raw header data.
+    # The envelope is walked once and only the three fields are taken out of it.
+    # Snapshots without a server header are kept, since they still show that the domain was crawled.
+    envelope = loads_snapshot(crawl).get("Envelope",{})
+    headers = envelope.get("Payload-Metadata",{}).get("HTTP-Response-Metadata",{}).get("Headers",{})
+    header_metadata = envelope.get("WARC-Header-Metadata",None)
+    if header_metadata is None:
+        header_metadata = envelope.get("ARC-Header-Metadata",{})
+    return (
+        header_metadata.get("Target-URI",np.NaN),
+        headers.get("Server",np.NaN),
+        headers.get("Date",np.NaN)
+    )
+
+def aggregate_snapshots(rows):
+    # Turns a batch of parsed snapshots into rows of the raw header panel.
+    # When the snapshots are aggregated, the snapshots with the same url, server header and date
+    # become one row with their number. The rows are kept in the order in which they first appear,
+    # so that the snapshots keep their order when the panel is balanced.
+    # The observation that is kept by default depends on the order in which the date strings first
+    # appear, so the dates are only replaced by their month with MODAL_OBSERVATIONS, which merges
+    # all of the snapshots of a url and server in a month. This is done for the dates in the RFC 1123
+    # and asctime formats, which encode_dates parses to the same month as the date. The dates in the
+    # RFC 850 format are kept as they are, since the century of their two digit years depends on
+    # the day that they are parsed.
+    # Empty strings and the other strings that read_csv reads as missing are missing values.
+    df = pd.DataFrame(rows, columns=['target_url','server','date'])
+    df = mask_missing_strings(df)
+    if not AGGREGATE_SNAPSHOTS or len(df)==0:
+        return df
+    if MODAL_OBSERVATIONS:
+        dt, path = parse_http_dates(df['date'].astype(object))
+        months = path.isin(['rfc1123','asctime']).values
+        codes, uniques = pd.factorize(month_code(dt[months]))
+        df.loc[months, 'date'] = np.array(["%04d-%02d" % (m//12, m%12 + 1) for m in uniques], dtype=object)[codes]
+
+    # Each combination of the codes of the three columns, where missing values have their own code
+    key = np.zeros(len(df), dtype='int64')
+    for col in df.columns:
+        codes, uniques = pd.factorize(df[col])
+        key = key*(len(uniques)+1) + codes + 1
+    _, first, n = np.unique(key, return_index=True, return_counts=True)
+    order = np.argsort(first)
+    df = df.iloc[first[order]].reset_index(drop=True)
+    df['n'] = n[order]
     return df
 
 ######################################
@@ -276,6 +1166,260 @@ def encode_server_string(server):
                 found = True
     return output['name'],output['version']
 
+def classify_server_strings(servers):
+    # Vectorized version of encode_server_string that runs over the whole column at once.
+    groups = servers.str.strip().str.extract(RE_SERVER)
+    output = pd.DataFrame({'server_name': "Other", 'server_version': None}, index=servers.index)
+    for i, (name, regex) in enumerate(SERVER_VENDORS):
+        group = RE_SERVER.groupindex['vendor%d' % i]
+        found = groups.iloc[:, group-1].notnull()
+        output.loc[found, 'server_name'] = name
+        if regex.groups>0:
+            output.loc[found, 'server_version'] = groups.loc[found].iloc[:, group]
+    return output
+
+def classify_servers(servers):
+    # Classifies the server header strings, reusing the results for the strings that have
+    # been seen before. Missing servers are not in the cache and are classified as Other.
+    # The rules cover the names of the vendors as well as their patterns.
+    rules = "\n".join([RE_SERVER.pattern] + [name for name, _ in SERVER_VENDORS])
+    output = cached_lookup(servers, 'servers', rules, classify_server_strings)
+    output['server_name'] = output['server_name'].fillna("Other")
+    return output
+
+######################################
+# Balancing
+######################################
+def month_code(dt):
+    return dt.dt.year.values*12 + dt.dt.month.values - 1
+
+def month_start(code):
+    return (np.asarray(code) - 1970*12).astype('datetime64[M]').astype('datetime64[ns]')
+
+def observation_order(df):
+    # The order in which best_observations ranks the snapshots of a domain and month: by the first
+    # appearance of their date strings in the raw panel (the order of the date codes), and then by row
+    return df['date_id'].values.astype('int64')*(df['row'].max()+1) + df['row'].values
+
+def best_observations(df):
+    # Picks one observation per domain and month from a panel of integer codes with the columns
+    # domain_id, month, date_id, name_id, version_id, n and row, where -1 is a missing vendor or
+    # version and n is the number of snapshots that the row stands for.
+    # By default this keeps the snapshot that the published code kept. It meant to rank the snapshots,
+    # but it filled in the missing vendors and versions first, so every snapshot got the same rank.
+    # The first one in the order that its merge left them in was kept: by the first appearance of
+    # their date strings in the raw panel, which is the order of the date codes, and then by row.
+    # With MODAL_OBSERVATIONS every vendor and version combination in a month gets a priority:
+    # the number of snapshots with it if both the vendor and the version are there, -1 if only
+    # the vendor is there and -2 if neither is. The combination with the highest priority is kept
+    # and equally ranked ones go to the one that comes first in the same order.
+    # This is one grouped pass over the codes and one over the combinations, without any sorting.
+    combos = df.assign(order=observation_order(df)).groupby(['domain_id','month','name_id','version_id'], sort=False).agg(
+        size=('n','sum'), order=('order','min'))
+    combos = combos.reset_index()
+    if MODAL_OBSERVATIONS:
+        priority = pd.Series(np.where(combos['name_id']<0, -2,
+            np.where(combos['version_id']<0, -1, combos['size'])))
+        top = priority.groupby([combos['domain_id'].values, combos['month'].values], sort=False).transform('max')
+        combos = combos.loc[(priority==top).values]
+    best = combos.groupby(['domain_id','month'], sort=False)['order'].idxmin()
+    return combos.loc[best.values, ['domain_id','month','name_id','version_id']].reset_index(drop=True)
+
+def balance_panel(df):
+    # Takes one observation per domain and month, where the vendor is missing for the months in which
+    # we have a snapshot but no server header, and fills in the months between the observations.
+    # The months after an observation are filled with its vendor if the next observation has the
+    # same vendor. If the vendor changed then we don't know in which month it did so those months
+    # are left out. The version is filled in if it is the same as the latest version seen as a next
+    # version, i.e. the next observation's version unless that one is missing.
+    # The months after the last observation, up to the domain's last snapshot, are compared
+    # with the latest next vendor and version that were seen in the same way.
+    #
+    # Each observation is followed by the months that are filled in after it,
+    # so the panel is built in order without a cartesian product of the domains and months.
+    # The domain, vendor and version are categoricals and this works on their codes, where -1 is missing.
+    df = df.sort_values(['domain','dt'])
+    month = month_code(df['dt'])
+    domain = df['domain'].cat.codes.values
+    last_month = pd.Series(month).groupby(domain).transform('max').values
+
+    observed = df['server_name'].cat.codes.values>=0
+    month = month[observed]
+    last_month = last_month[observed]
+    domain = domain[observed]
+    server_name = df['server_name'].cat.codes.values[observed]
+    server_version = df['server_version'].cat.codes.values[observed]
+
+    # Without any observation that has a vendor there is nothing to fill in
+    n = len(domain)
+    if n==0:
+        return pd.DataFrame({
+            'domain': pd.Categorical.from_codes([], df['domain'].cat.categories),
+            'dt': month_start(np.zeros(0, dtype=int)),
+            'server_name': pd.Categorical.from_codes([], df['server_name'].cat.categories),
+            'server_version': pd.Categorical.from_codes([], df['server_version'].cat.categories),
+            'interpolated': np.zeros(0)
+            })
+
+    # The next observation of the same domain
+    has_next = np.zeros(n, dtype=bool)
+    has_next[:-1] = domain[1:]==domain[:-1]
+    month_next = np.append(month[1:], 0)
+    name_next = pd.Series(np.append(server_name[1:], -1)).where(has_next)
+    version_next = pd.Series(np.append(server_version[1:], -1)).where(has_next)
+    version_next = version_next.where(version_next>=0)
+    name_next = name_next.groupby(domain).ffill().values
+    version_next = version_next.groupby(domain).ffill().values
+
+    fill_until = np.where(has_next, month_next, last_month+1)
+    fill_until = np.where(server_name==name_next, fill_until, month+1)
+    fill_version = np.where(server_version==version_next, server_version, -1)
+    n_fill = fill_until - month - 1
+
+    # Expand each observation into itself and the months filled in after it
+    rows = np.repeat(np.arange(n), n_fill+1)
+    offset = np.arange(len(rows)) - np.repeat(np.cumsum(n_fill+1) - (n_fill+1), n_fill+1)
+    interpolated = offset>0
+    m = pd.DataFrame({
+        'domain': pd.Categorical.from_codes(domain[rows], df['domain'].cat.categories),
+        'dt': month_start(month[rows] + offset),
+        'server_name': pd.Categorical.from_codes(server_name[rows], df['server_name'].cat.categories),
+        'server_version': pd.Categorical.from_codes(
+            np.where(interpolated, fill_version[rows], server_version[rows]), df['server_version'].cat.categories),
+        'interpolated': interpolated.astype(float)
+        })
+    return m
+
+######################################
+# Event Log
+######################################
+# The balanced panel as runs of consecutive months in which a domain kept the same vendor and
+# version and was either observed or interpolated throughout, one row per run with its first and
+# last month as YYYYMM. Most domains keep their server for years, so this is much smaller than the
+# panel, and the monthly rows are only rebuilt when they are needed, e.g. for a window of months:
+#   expand_events(window_events(read_table('servers_panel_events'), '2005-01', '2006-12'))
+EVENT_DTYPES = {'domain': object, 'start_dm': 'int32', 'end_dm': 'int32', 'server_name': object, 'server_version': object, 'interpolated': 'int8'}
+EVENT_COLUMNS = list(EVENT_DTYPES)
+
+def dm_month(dm):
+    dm = np.asarray(dm)
+    return (dm//100)*12 + dm%100 - 1
+
+def month_dm(code):
+    code = np.asarray(code)
+    return (code//12)*100 + code%12 + 1
+
+def panel_events(m):
+    # Turns a balanced panel that is sorted by domain and month into its runs.
+    # A run ends when the domain, vendor, version or interpolated flag changes or a month is skipped.
+    if len(m)==0:
+        return pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in EVENT_DTYPES.items()})
+    month = month_code(m['dt'])
+    keys = [m[col].cat.codes.values for col in ['domain','server_name','server_version']] + [m['interpolated'].values]
+    new = np.ones(len(m), dtype=bool)
+    new[1:] = month[1:]!=month[:-1]+1
+    for key in keys:
+        new[1:] |= key[1:]!=key[:-1]
+    first = np.flatnonzero(new)
+    last = np.append(first[1:], len(m)) - 1
+    return pd.DataFrame({
+        'domain': decode(m['domain'].values[first]),
+        'start_dm': month_dm(month[first]).astype('int32'),
+        'end_dm': month_dm(month[last]).astype('int32'),
+        'server_name': decode(m['server_name'].values[first]),
+        'server_version': decode(m['server_version'].values[first]),
+        'interpolated': m['interpolated'].values[first].astype('int8')
+        }, columns=EVENT_COLUMNS)
+
+def expand_events(events):
+    # Rebuilds the monthly rows of the runs, in the same form as the balanced panel
+    start = dm_month(events['start_dm'].values)
+    length = dm_month(events['end_dm'].values) - start + 1
+    rows = np.repeat(np.arange(len(events)), length)
+    offset = np.arange(len(rows)) - np.repeat(np.cumsum(length) - length, length)
+    m = events.iloc[rows][['domain','server_name','server_version']].reset_index(drop=True)
+    m.insert(1, 'dt', month_start(start[rows] + offset))
+    m['interpolated'] = events['interpolated'].values[rows].astype(float)
+    return m
+
+def window_events(events, start, end, domains=None):
+    # The runs that overlap the months from start to end (e.g. '2005-01'), cut to those months
+    start, end = [month_code(pd.Series(pd.to_datetime([dt]))) for dt in (start, end)]
+    first = np.maximum(dm_month(events['start_dm'].values), start)
+    last = np.minimum(dm_month(events['end_dm'].values), end)
+    keep = first<=last
+    if domains is not None:
+        keep &= events['domain'].isin(domains).values
+    events = events.loc[keep].copy()
+    events['start_dm'] = month_dm(first[keep]).astype('int32')
+    events['end_dm'] = month_dm(last[keep]).astype('int32')
+    return events
+
+def server_switches(events):
+    # The changes of vendor or version between the observed runs of each domain, with the
+    # vendor and version before and the first month that the new ones were observed, e.g.
+    #   switches.loc[(switches['server_name_before']=='Apache') & (switches['server_name']=='Nginx')]
+    observed = events.loc[events['interpolated']==0].reset_index(drop=True)
+    before = observed.shift(1)
+    # A missing version is the same as another missing version
+    changed = (observed['domain']==before['domain']) & (
+        (observed['server_name']!=before['server_name']) |
+        (observed['server_version'].fillna('')!=before['server_version'].fillna('')))
+    switches = observed.loc[changed, ['domain','start_dm','server_name','server_version']]
+    for col in ['server_name','server_version']:
+        switches.insert(switches.columns.get_loc(col), col + '_before', before.loc[changed, col])
+    return switches.rename(columns={'start_dm': 'dm'}).reset_index(drop=True)
+
+######################################
+# Dates
+######################################
+# The three date formats allowed in HTTP headers (RFC 2616 section 3.3.1):
+#   RFC 1123: Sun, 06 Nov 1994 08:49:37 GMT
+#   RFC 850:  Sunday, 06-Nov-94 08:49:37 GMT
+#   asctime:  Sun Nov  6 08:49:37 1994
+# Only the date part is extracted, like the short slice of the string that the
+# general parser is given for the RFC 1123 dates.
+# The aggregated snapshots have the months of their dates instead, e.g. 1994-11.
+RE_HTTP_DATE = re.compile(
+    '^(?:[A-Za-z]{3}, {1,2}(?P<rfc1123_day>\d{1,2}) (?P<rfc1123_month>[A-Za-z]{3}) (?P<rfc1123_year>\d{4})(?: |$)'
+    '|[A-Za-z]+, (?P<rfc850_day>\d{2})-(?P<rfc850_month>[A-Za-z]{3})-(?P<rfc850_year>\d{2}) \d{2}:\d{2}:\d{2} GMT$'
+    '|[A-Za-z]{3} (?P<asctime_month>[A-Za-z]{3}) {1,2}(?P<asctime_day>\d{1,2}) \d{2}:\d{2}:\d{2} (?P<asctime_year>\d{4})$'
+    '|(?P<month_year>\d{4})-(?P<month_month>\d{2})$)')
+
+MONTHS = {
+    'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4, 'may': 5, 'jun': 6,
+    'jul': 7, 'aug': 8, 'sep': 9, 'oct': 10, 'nov': 11, 'dec': 12
+}
+
+def parse_http_dates(dates):
+    # Parses the date header strings that are in one of the standard formats.
+    # Returns the dates (in UTC) and the format that each one was parsed with.
+    # Strings in any other format, or with an invalid date, are left missing for the general parser.
+    parts = dates.str.extract(RE_HTTP_DATE)
+    dt = pd.Series(pd.NaT, index=dates.index, dtype='datetime64[ns, UTC]')
+    path = pd.Series(None, index=dates.index, dtype=object)
+    for name in ['rfc1123','rfc850','asctime','month']:
+        found = parts[name+'_year'].notnull()
+        year = pd.to_numeric(parts.loc[found, name+'_year'])
+        # Two digit years are put in the century that is closest to today,
+        # the same as the general parser does.
+        if name=='rfc850':
+            this_year = datetime.date.today().year
+            year = year + this_year//100*100
+            year = year.where(year<this_year+50, year-100)
+            year = year.where(year>=this_year-50, year+100)
+        if name=='month':
+            month = pd.to_numeric(parts.loc[found, name+'_month'])
+            day = 1
+        else:
+            month = parts.loc[found, name+'_month'].str.lower().map(MONTHS)
+            day = pd.to_numeric(parts.loc[found, name+'_day'])
+        parsed = pd.to_datetime(pd.DataFrame({'year': year, 'month': month, 'day': day}), errors='coerce', utc=True)
+        parsed = parsed.loc[parsed.notnull()]
+        dt.loc[parsed.index] = parsed
+        path.loc[parsed.index] = name
+    return dt, path
+
 ######################################
 # DMs
 ######################################
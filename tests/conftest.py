@@ -0,0 +1,25 @@
+# The checks import the pipeline code the same way the stages do, with code/ on the path.
+import os
+import random
+import subprocess
+import sys
+import zipfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CODE_DIR = os.path.join(REPO_DIR, "code")
+sys.path.insert(0, CODE_DIR)
+from make_synthetic_inputs import IA_DIR, make_snapshot
+
+def run_stages(root, stages, **settings):
+    # Runs the stages one after the other in their own processes, as make does
+    env = dict(os.environ, INCREMENTAL="0", N_JOBS="1", PYTHONWARNINGS="ignore")
+    env.update(settings)
+    for stage in stages:
+        subprocess.run([sys.executable, os.path.join(CODE_DIR, stage + ".py")], cwd=root, env=env,
+            check=True, stdout=subprocess.DEVNULL)
+
+def write_zip(root, name, snapshots):
+    # Writes a zip of raw header data with one crawl file of the given (url, server, date) snapshots
+    rng = random.Random(0)
+    with zipfile.ZipFile(os.path.join(root, IA_DIR, name), "w") as f:
+        f.writestr("crawl_000.json", "".join(make_snapshot(rng, url, server, date) + "\n" for url, server, date in snapshots))
@@ -0,0 +1,197 @@
+# Checks the balancing of the panel against the published algorithm, on small random panels
+# and on the edge cases: no observations at all and domains whose snapshots never had a vendor.
+# The observation kept per domain and month is checked the same way, with ties between the snapshots,
+# and the digests of the domains' rows that the incremental mode compares are checked on their own.
+import warnings
+import numpy as np
+import pandas as pd
+import pytest
+import utils
+
+VENDORS = ['Apache', 'IIS', 'nginx']
+VERSIONS = ['1.0', '2.0', '6.0']
+
+def random_observations(seed, n_domains=40, n_months=30):
+    # One observation per domain and month, with a missing vendor or version now and then
+    # and domains that switch servers, skip months, or never have a vendor
+    rng = np.random.default_rng(seed)
+    rows = []
+    for d in range(n_domains):
+        months = np.sort(rng.choice(n_months, size=rng.integers(1, 12), replace=False))
+        unobserved = rng.random()<0.1
+        for month in months:
+            name = None if unobserved or rng.random()<0.15 else VENDORS[rng.integers(0, 2 if d%2 else 3)]
+            version = None if name is None or rng.random()<0.2 else VERSIONS[rng.integers(0, 2)]
+            rows.append(("d%03d.com" % d, pd.Timestamp(2005, 1, 1) + pd.DateOffset(months=int(month)), name, version))
+    return pd.DataFrame(rows, columns=['domain','dt','server_name','server_version'])
+
+def published_balance(df):
+    # The imputation of balance_the_panel.py as it was published, from one observation per domain and month
+    df = df.sort_values(['domain','dt'])
+    df = df[['domain','dt','server_name','server_version']]
+    observed_data = df.loc[df['server_name'].notnull()].copy()
+    for col in ['server_name','server_version']:
+        observed_data[col+"_next"] = observed_data.groupby(["domain"])[col].shift(-1)
+    observed_data['interpolated'] = 0
+
+    domains = df[['domain']].drop_duplicates()
+    domains['key'] = 1
+    dts = pd.DataFrame(pd.date_range(min(df.dt),max(df.dt),freq='MS'),columns=['dt'])
+    dts['key'] = 1
+    first_ob = df.groupby("domain")['dt'].min()
+    first_ob.name = 'dt_first'
+    first_ob = first_ob.reset_index()
+    last_ob = df.groupby("domain")['dt'].max()
+    last_ob.name = 'dt_last'
+    last_ob = last_ob.reset_index()
+
+    m = pd.merge(domains,dts,on='key')
+    m = pd.merge(m,first_ob,on='domain')
+    m = pd.merge(m,last_ob,on='domain')
+    m = m.loc[(m['dt']>=m['dt_first']) & (m['dt']<=m['dt_last'])]
+    del m['dt_first']
+    del m['dt_last']
+    m = pd.merge(m,observed_data,on=['domain','dt'],how='left')
+    del m['key']
+    m['interpolated'] = m['interpolated'].fillna(1)
+    m.loc[(m['interpolated']==0) & (m['server_name'].isnull()),'server_name'] = ''
+    m.loc[(m['interpolated']==0) & (m['server_version'].isnull()),'server_version'] = ''
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        m['server_name'] = m.groupby(['domain'])['server_name'].fillna(method='ffill')
+        m['server_name_next'] = m.groupby(['domain'])['server_name_next'].fillna(method='ffill')
+        m.loc[(m['server_name']!=m['server_name_next']) & (m['interpolated']==1), 'server_name'] = np.NaN
+        m['server_version'] = m.groupby(['domain'])['server_version'].fillna(method='ffill')
+        m['server_version_next'] = m.groupby(['domain'])['server_version_next'].fillna(method='ffill')
+        m.loc[((m['server_name']!=m['server_name_next']) | (m['server_version']!=m['server_version_next'])) &
+            (m['interpolated']==1), 'server_version'] = np.NaN
+
+    m = m.loc[m['server_name'].notnull()]
+    m = m[['domain','dt','server_name','server_version','interpolated']]
+    m.loc[m['server_name']=='','server_name'] = np.NaN
+    m.loc[m['server_version']=='','server_version'] = np.NaN
+    return m.reset_index(drop=True)
+
+def balance(df):
+    # The panel balanced by balance_panel, from the same observations as categoricals
+    df = df.copy()
+    for col in ['domain','server_name','server_version']:
+        df[col] = pd.Categorical(df[col], categories=sorted(df[col].dropna().unique()))
+    return utils.balance_panel(df)
+
+def as_published(m):
+    m = m.copy()
+    for col in ['domain','server_name','server_version']:
+        m[col] = m[col].astype(object).where(m[col].notnull(), np.NaN)
+    return m.reset_index(drop=True)
+
+@pytest.mark.parametrize("seed", range(5))
+def test_balance_panel(seed):
+    df = random_observations(seed)
+    expected = published_balance(df)
+    assert len(expected)>len(df.dropna(subset=['server_name']))
+    pd.testing.assert_frame_equal(as_published(balance(df)), expected)
+
+def test_balance_panel_without_vendors():
+    df = random_observations(0)
+    df['server_name'] = None
+    df['server_version'] = None
+    m = balance(df)
+    assert len(published_balance(df))==0
+    assert len(m)==0
+    assert list(m.columns)==['domain','dt','server_name','server_version','interpolated']
+
+def test_balance_panel_empty():
+    m = balance(random_observations(0).iloc[:0])
+    assert len(m)==0
+    assert list(m.columns)==['domain','dt','server_name','server_version','interpolated']
+    assert m['dt'].dtype=='datetime64[ns]'
+
+def random_snapshots(seed, n_domains=30, n_months=6):
+    # Coded snapshots as balance_the_panel reads them, with several date strings per month
+    # that first appear in random order, and few vendors and versions so that there are ties
+    rng = np.random.default_rng(seed)
+    n = 2000
+    dates = rng.integers(0, n_months*3, size=n)
+    df = pd.DataFrame({
+        'domain_id': rng.integers(0, n_domains, size=n),
+        'month': dates//3,
+        'date_id': pd.factorize(dates)[0],
+        'name_id': rng.integers(-1, 2, size=n),
+        'version_id': rng.integers(-1, 2, size=n),
+        'n': rng.integers(1, 4, size=n),
+        })
+    df.loc[df['name_id']<0, 'version_id'] = -1
+    df['row'] = np.arange(n)
+    return df
+
+def published_observations(df):
+    # The observation that the published balance_the_panel.py kept per domain and month. It ranked
+    # the snapshots after their vendors and versions were filled in with empty strings, so all of
+    # them were ranked the same and the first one in the order of the merge on the date was kept.
+    df = df.loc[np.repeat(df.index.values, df['n'].values)]
+    df = df.sort_values(['date_id','row'], kind='mergesort')
+    df['server_name'] = df['name_id'].astype(str).where(df['name_id']>=0, "")
+    df['server_version'] = df['version_id'].astype(str).where(df['version_id']>=0, "")
+    obs_per_server = df.groupby(['domain_id','month','server_name','server_version']).size()
+    obs_per_server.name = 'obs'
+    df = pd.merge(df, obs_per_server.reset_index(), on=['domain_id','month','server_name','server_version'], how='left')
+    df.loc[(df['server_name'].notnull()) | (df['server_version'].isnull()), 'obs'] = -1
+    df.loc[(df['server_name'].isnull()) & (df['server_version'].isnull()), 'obs'] = -2
+    df = df.sort_values(['domain_id','month','obs'], ascending=[True,True,False])
+    df = df.groupby(['domain_id','month']).first().reset_index()
+    return df[['domain_id','month','name_id','version_id']]
+
+def modal_observations(df):
+    # The observation that the published code meant to keep: the vendor and version with the most
+    # snapshots in the month, then one without a version and then one without a vendor,
+    # with ties going to the first snapshot in the order of the merge on the date
+    df = df.loc[np.repeat(df.index.values, df['n'].values)]
+    df = df.sort_values(['date_id','row'], kind='mergesort').reset_index(drop=True)
+    size = df.groupby(['domain_id','month','name_id','version_id'])['row'].transform('size')
+    obs = np.where(df['name_id']<0, -2, np.where(df['version_id']<0, -1, size))
+    df = df.iloc[np.lexsort((-obs, df['month'].values, df['domain_id'].values))]
+    df = df.groupby(['domain_id','month']).first().reset_index()
+    return df[['domain_id','month','name_id','version_id']]
+
+def best(df):
+    return utils.best_observations(df).sort_values(['domain_id','month']).reset_index(drop=True)
+
+@pytest.mark.parametrize("seed", range(5))
+def test_best_observations(seed):
+    df = random_snapshots(seed)
+    pd.testing.assert_frame_equal(best(df), published_observations(df), check_dtype=False)
+
+@pytest.mark.parametrize("seed", range(5))
+def test_modal_observations(seed, monkeypatch):
+    monkeypatch.setattr(utils, 'MODAL_OBSERVATIONS', True)
+    df = random_snapshots(seed)
+    modal = best(df)
+    pd.testing.assert_frame_equal(modal, modal_observations(df), check_dtype=False)
+    assert not modal.equals(published_observations(df).astype(modal.dtypes))
+
+def test_domain_digests():
+    # A domain's digest only depends on its own rows and their order
+    rng = np.random.default_rng(0)
+    domain_id = rng.integers(0, 50, size=1000)
+    row_hashes = rng.integers(0, 5, size=1000).astype('uint64')
+    digests = utils.domain_digests(domain_id, row_hashes)
+    assert sorted(digests.index)==sorted(np.unique(domain_id))
+    assert digests.index.is_unique
+    for d in [0, 7, 49]:
+        rows = np.flatnonzero(domain_id==d)
+        assert utils.domain_digests(np.full(len(rows), 99), row_hashes[rows])[99]==digests[d]
+        # Moving a row of the domain behind its last row changes its digest but none of the others
+        moved = rows[row_hashes[rows]!=row_hashes[rows[-1]]][0]
+        order = np.append(np.delete(np.arange(len(domain_id)), moved), moved)
+        changed = utils.domain_digests(domain_id[order], row_hashes[order])
+        assert changed[d]!=digests[d]
+        assert (changed.drop(d)==digests.drop(d)).all()
+        # And so does a change to one of its rows
+        edited = row_hashes.copy()
+        edited[moved] += np.uint64(1)
+        assert utils.domain_digests(domain_id, edited)[d]!=digests[d]
+
+def test_domain_digests_empty():
+    assert len(utils.domain_digests(np.zeros(0, dtype=int), np.zeros(0, dtype='uint64')))==0
@@ -0,0 +1,62 @@
+# Checks that the date header strings that parse_http_dates parses directly get the same month
+# and year as with the two passes of to_datetime that encode_dates.py published, and that it leaves
+# the strings that those couldn't parse for the general parser.
+import datetime
+import pandas as pd
+import utils
+
+def rfc850(year):
+    return "Monday, 03-Jan-%02d 10:00:00 GMT" % (year % 100)
+
+# The two digit years are put in the century closest to today, so the ones around the pivot move
+THIS_YEAR = datetime.date.today().year
+PIVOT = [rfc850(year) for year in range(THIS_YEAR+47, THIS_YEAR+54)] + [rfc850(THIS_YEAR), rfc850(0), rfc850(99)]
+
+# The strings in the standard formats, which are parsed directly
+STANDARD = [
+    # RFC 1123, with single digit and space padded days and lower case names
+    "Mon, 03 Jan 2005 10:00:00 GMT", "Mon,  3 Jan 2005 10:00:00 GMT", "Mon, 3 Jan 2005 10:00:00 GMT",
+    "mon, 03 jan 2005 10:00:00 gmt", "MON, 03 JAN 2005 10:00:00 GMT", "Sat, 31 Dec 2005 23:59:59 GMT",
+    "Mon, 03 Jan 2005", "Mon, 03 Jan 2005 10:00:00 +0100", "Thu, 01 Jan 1970 00:00:00 GMT",
+    # RFC 850
+    "Monday, 03-Jan-05 10:00:00 GMT", "sunday, 31-dec-17 23:59:59 GMT",
+    # asctime
+    "Mon Jan  3 10:00:00 2005", "Mon Jan 13 10:00:00 2005", "Mon jan 3 10:00:00 2005",
+    # The months that the snapshots are aggregated to
+    "2005-01", "2017-12",
+    ] + PIVOT
+
+DATES = STANDARD + [
+    # Invalid months and days, next to a valid leap day
+    "2005-13", "1999-00",
+    "Mon, 31 Feb 2005 10:00:00 GMT", "Mon, 29 Feb 2004 10:00:00 GMT", "Mon, 29 Feb 2005 10:00:00 GMT",
+    "Mon, 00 Jan 2005 10:00:00 GMT", "Monday, 31-Feb-05 10:00:00 GMT", "Mon Feb 30 10:00:00 2005",
+    # Everything else
+    "Mon, 03 Xyz 2005 10:00:00 GMT", "2005-01-03T10:00:00Z", "03 Jan 2005", "garbage", "0", "",
+    ]
+
+def published_dates(dates):
+    # The month and year of each date string as encode_dates.py published them
+    dates = dates.to_frame('date')
+    dates['date_short'] = dates['date'].str[4:16]
+    short_dates = dates[['date_short']].drop_duplicates()
+    short_dates['dt'] = pd.to_datetime(short_dates['date_short'],errors='coerce')
+    short_dates = short_dates.loc[short_dates['dt'].notnull()]
+    short_dates = pd.merge(dates,short_dates,on='date_short')
+    remaining_dates = dates.loc[~dates['date_short'].isin(short_dates['date_short'])].copy()
+    remaining_dates['dt'] = pd.to_datetime(remaining_dates['date'],errors='coerce')
+    remaining_dates = remaining_dates.loc[remaining_dates['dt'].notnull()]
+    dates = pd.concat([short_dates,remaining_dates],axis=0)
+    dates['dt'] = pd.to_datetime(dates['dt'],errors='coerce',utc=True)
+    dates['dm'] = dates['dt'].dt.strftime("%Y%m")
+    dates['yr'] = pd.to_numeric(dates['dt'].dt.strftime("%Y"),errors='coerce')
+    return dates.loc[dates['yr'].notnull()].set_index('date')[['dm','yr']]
+
+def test_parse_http_dates():
+    dates = pd.Series(DATES, dtype=object)
+    dt, path = utils.parse_http_dates(dates)
+    assert path.loc[dates.isin(STANDARD)].notnull().all()
+    assert path.loc[dates.isin(PIVOT)].eq('rfc850').all()
+    parsed = pd.DataFrame({'dm': dt.dt.strftime("%Y%m"), 'yr': dt.dt.year}).set_index(dates).loc[dt.notnull().values]
+    expected = published_dates(dates).reindex(parsed.index)
+    pd.testing.assert_frame_equal(parsed, expected, check_dtype=False)
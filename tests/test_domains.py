@@ -0,0 +1,73 @@
+# Checks that the vectorized domain normalization gives the same domains as extract_domain,
+# which runs tldextract on one url at a time, and that the cached domains are redone when the
+# url cleaners change.
+import random
+import pandas as pd
+import pytest
+import utils
+
+URLS = [
+    # The url variants of the crawl
+    "http://www.example.com/", "http://example.com", "https://www.example.com/", "http://www2.example.com/index.html",
+    "http://ww.example.com/", "http://example.com:80/about/", "http://http//www.example.com/", "http://1.example.com/",
+    "http://example.net/a/b", "http://example.org/?q=1", "http://shop.example.co.uk/", "http://a.b.example.com.au:8080/x",
+    # Upper case, user info, ports and trailing dots
+    "HTTP://WWW.EXAMPLE.COM/", "http://Example.Co.UK", "http://user:pw@site.com/", "http://a@b@c.com",
+    "http://site.com:8080", "http://site.com.:80/", "http://site.com./", "example.com.", "//example.com/x",
+    # Wildcard and exception rules of the public suffix list
+    "http://foo.ck/", "http://bar.foo.ck/", "http://www.ck/", "http://a.www.ck/", "http://foo.kawasaki.jp/",
+    "http://bar.foo.kawasaki.jp/", "http://city.kawasaki.jp/", "http://a.city.kawasaki.jp/", "http://foo.bd", "http://x.foo.bd",
+    # Hosts without a public suffix and ip addresses
+    "http://localhost:80/", "http://192.168.0.1/index.html", "http://10.0.0.300/", "http://[2001:db8::1]:80/x", "http://intranet",
+    # Characters outside of ASCII, punycode and whitespace
+    "http://münchen.de/", "http://www.ÉCOLE.fr", "http://xn--mnchen-3ya.de/", "http://XN--MNCHEN-3YA.DE", "http://shop.例え.jp/",
+    "http://example。com/", "http://example.com/%ef%bb%bf", "a.com\n", " http://example.com ", "http://example.com/x y",
+    # Degenerate urls
+    "", " ", "http://", ".com", "com", "http://.", "http://xn--.com", "mailto:someone@example.com",
+    ]
+
+def random_urls(seed, n=5000):
+    # Urls built from parts that exercise the cleaners, the host name parsing and the suffix rules
+    rng = random.Random(seed)
+    suffixes = utils.get_public_suffixes()
+    exact = sorted(suffixes['exact'])
+    wildcard = sorted(suffixes['wildcard'])
+    exception = sorted(suffixes['exception'])
+    labels = ['www', 'ww', 'www2', 'a', 'b-c', 'Shop', 'xn--bcher-kva', '1', 'com', 'net', 'org', '', 'münchen', 'ÉCOLE']
+    schemes = ['http://', 'https://', '', '//', 'HTTP://', 'http//', 'http://http//', 'http://1.', 'http://.']
+    tails = ['', '/', '/index.html', ':80/', ':8080', '?q=1', '#frag', '/a.com/b', '.', '/%ef%bb%bf', '@evil.com', ' ', '/x y']
+    urls = []
+    for _ in range(n):
+        r = rng.random()
+        if r<0.05:
+            host = '.'.join(str(rng.randint(0, 300)) for _ in range(4))
+        elif r<0.1:
+            host = 'user:pw@site%d.com' % rng.randint(0, 9)
+        else:
+            host = [rng.choice(labels) for _ in range(rng.randint(0, 2))] + [rng.choice(['acme', 'ACME', 'site9', 'a..b'])]
+            if r<0.3:
+                host += [rng.choice(labels), rng.choice(wildcard)]
+            elif r<0.35:
+                host += [rng.choice(exception)]
+            else:
+                host += [rng.choice(exact)]
+            host = '.'.join(host)
+            if rng.random()<0.1:
+                host = host.upper()
+        urls.append(rng.choice(schemes) + host + rng.choice(tails))
+    return urls
+
+@pytest.mark.parametrize("urls", [URLS] + [random_urls(seed) for seed in range(3)])
+def test_normalize_domain_strings(urls):
+    urls = pd.Series(urls, dtype=object)
+    domains = utils.normalize_domain_strings(urls)['domain']
+    expected = urls.map(utils.extract_domain)
+    assert list(domains)==list(expected)
+
+def test_normalize_domains_cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    urls = pd.Series(["http://foo.net/index.html", "http://bar.com/"])
+    assert list(utils.normalize_domains(urls))==['foo.com', 'bar.com']
+    cleaner = [k for k in utils.URL_CLEANERS if k.pattern.startswith('\\.net')][0]
+    monkeypatch.setitem(utils.URL_CLEANERS, cleaner, '.net')
+    assert list(utils.normalize_domains(urls))==['foo.net', 'bar.com']
@@ -0,0 +1,70 @@
+# Checks that aggregating the snapshots as they are extracted doesn't change which observations
+# are kept: expanding the aggregated rows by their numbers gives back the snapshots in the same
+# order, and the observation picked per domain and month is the same from either panel.
+import numpy as np
+import pandas as pd
+import pytest
+import utils
+
+DATES = {
+    'Mon, 03 Jan 2005 10:00:00 GMT': 0, 'Tue, 04 Jan 2005 11:00:00 GMT': 0,
+    'Tuesday, 04-Jan-05 11:00:00 GMT': 0, 'Wed Feb  2 09:30:00 2005': 1,
+    'Thu, 03 Feb 2005 10:00:00 GMT': 1, 'Tue, 01 Mar 2005 00:00:00 GMT': 2,
+    }
+
+def random_rows(seed, n=3000):
+    # Parsed snapshots of a few urls, with missing server headers and dates and many duplicates
+    rng = np.random.default_rng(seed)
+    urls = np.array(["http://d%02d.com/" % i for i in range(15)], dtype=object)
+    servers = np.array(['Apache/2.0', 'Microsoft-IIS/6.0', 'nginx', ''], dtype=object)
+    dates = np.array(list(DATES) + [''], dtype=object)
+    return list(zip(urls[rng.integers(0, len(urls), n)], servers[rng.integers(0, len(servers), n)],
+        dates[rng.integers(0, len(dates), n)]))
+
+def coded(df):
+    # The panel codes that build_dictionaries writes, with the months that encode_dates gives the dates
+    date_id = pd.factorize(df['date'])[0]
+    return pd.DataFrame({
+        'domain_id': pd.factorize(df['target_url'])[0],
+        'month': df['date'].map(DATES).fillna(-1).astype(int).values,
+        'date_id': date_id,
+        'name_id': pd.factorize(df['server'])[0],
+        'version_id': -1,
+        'n': df['n'].values if 'n' in df else 1,
+        'row': np.arange(len(df)),
+        }).loc[lambda codes: codes['month']>=0]
+
+@pytest.fixture
+def aggregated(monkeypatch):
+    monkeypatch.setattr(utils, 'AGGREGATE_SNAPSHOTS', True)
+    monkeypatch.setattr(utils, 'MODAL_OBSERVATIONS', False)
+
+@pytest.mark.parametrize("seed", range(3))
+def test_aggregate_snapshots(seed, aggregated, monkeypatch):
+    rows = random_rows(seed)
+    df = utils.aggregate_snapshots(rows)
+    assert len(df)<len(rows)
+    monkeypatch.setattr(utils, 'AGGREGATE_SNAPSHOTS', False)
+    snapshots = utils.aggregate_snapshots(rows)
+    assert 'n' not in snapshots
+    assert snapshots['server'].isnull().any() and snapshots['date'].isnull().any()
+
+    # The aggregated rows are the distinct snapshots in the order they first appear, with their numbers
+    expected = snapshots.drop_duplicates().reset_index(drop=True)
+    pd.testing.assert_frame_equal(df[['target_url','server','date']], expected)
+    n = snapshots.groupby(['target_url','server','date'], dropna=False, sort=False).size().values
+    np.testing.assert_array_equal(df['n'].values, n)
+
+    # So the date codes come out in the same order and the same observations are kept
+    pd.testing.assert_frame_equal(utils.best_observations(coded(df)), utils.best_observations(coded(snapshots)))
+
+def test_aggregate_snapshots_by_month(aggregated, monkeypatch):
+    monkeypatch.setattr(utils, 'MODAL_OBSERVATIONS', True)
+    df = utils.aggregate_snapshots(random_rows(0))
+    assert set(df['date'].dropna())=={'2005-01', '2005-02', '2005-03', 'Tuesday, 04-Jan-05 11:00:00 GMT'}
+    assert df.duplicated(['target_url','server','date']).sum()==0
+
+def test_aggregate_snapshots_empty(aggregated):
+    df = utils.aggregate_snapshots([])
+    assert len(df)==0
+    assert list(df.columns)==['target_url','server','date']
@@ -0,0 +1,44 @@
+# Checks that the storage format of the intermediate tables doesn't change the panel. The raw
+# header panel was read back with read_csv, which reads 'NULL', 'N/A' and the like as missing,
+# so a snapshot with such a Server header is one without a vendor and is imputed over.
+import os
+import shutil
+import pandas as pd
+import pytest
+from conftest import REPO_DIR, run_stages, write_zip
+from make_synthetic_inputs import write_inputs
+
+STAGES = ['extract_cookie_data','build_dictionaries','encode_servers','encode_dates','balance_the_panel']
+
+@pytest.fixture(scope="module")
+def panels(tmp_path_factory):
+    inputs = str(tmp_path_factory.mktemp("inputs"))
+    cwd = os.getcwd()
+    os.chdir(REPO_DIR)
+    try:
+        write_inputs(inputs, n_domains=20, n_zips=1, n_crawl_files=2, months=12, seed=3)
+    finally:
+        os.chdir(cwd)
+    write_zip(inputs, "a.zip", [
+        ("http://site0.com/", "Apache/2.2.15", "Mon, 03 Jan 2005 10:00:00 GMT"),
+        ("http://site0.com/", "NULL", "Thu, 03 Feb 2005 10:00:00 GMT"),
+        ("http://site0.com/", "Apache/2.2.15", "Sun, 03 Apr 2005 10:00:00 GMT"),
+        ("http://site1.com/", "Microsoft-IIS/6.0", "Mon, 03 Jan 2005 10:00:00 GMT"),
+        ("http://site1.com/", "N/A", "Thu, 03 Feb 2005 10:00:00 GMT"),
+        ("http://site1.com/", "null", "Thu, 03 Mar 2005 10:00:00 GMT"),
+        ("http://site1.com/", "Microsoft-IIS/6.0", "Tue, 03 May 2005 10:00:00 GMT"),
+        ])
+    panels = {}
+    for panel_format in ['parquet', 'csv']:
+        root = str(tmp_path_factory.mktemp(panel_format))
+        shutil.copytree(inputs, root, dirs_exist_ok=True)
+        os.makedirs(os.path.join(root, "output"))
+        run_stages(root, STAGES, PANEL_FORMAT=panel_format)
+        panels[panel_format] = pd.read_hdf(os.path.join(root, "output/servers_panel_semibalanced.h5"), 'df')
+    return panels['parquet'], panels['csv']
+
+def test_panel_formats(panels):
+    parquet, csv = panels
+    for domain, n in [('site0.com', 2), ('site1.com', 3)]:
+        assert parquet.loc[parquet['domain']==domain, 'interpolated'].sum()==n
+    pd.testing.assert_frame_equal(parquet, csv)
@@ -0,0 +1,48 @@
+# Checks that the incremental mode gives the same panel as a full rebuild when new snapshots of
+# other domains change the order in which the date strings first appear, which decides the
+# observation that is kept for a month with several snapshots.
+import os
+import pandas as pd
+import pytest
+from conftest import REPO_DIR, run_stages, write_zip
+from make_synthetic_inputs import write_inputs
+
+STAGES = ['extract_cookie_data','build_dictionaries','encode_servers','encode_dates','balance_the_panel']
+MON = "Mon, 03 Jan 2005 10:00:00 GMT"
+TUE = "Tue, 04 Jan 2005 10:00:00 GMT"
+
+def read_panel(root):
+    return pd.read_hdf(os.path.join(root, "output/servers_panel_semibalanced.h5"), 'df')
+
+@pytest.fixture(scope="module")
+def panels(tmp_path_factory):
+    root = str(tmp_path_factory.mktemp("incremental"))
+    cwd = os.getcwd()
+    os.chdir(REPO_DIR)
+    try:
+        write_inputs(root, n_domains=5, n_zips=1, n_crawl_files=1, months=12, seed=2)
+    finally:
+        os.chdir(cwd)
+    os.makedirs(os.path.join(root, "output"))
+
+    # x.com had Apache and IIS in January, and Apache again in March.
+    # The zips sort before the synthetic ones, so their snapshots come first in the raw panel.
+    write_zip(root, "b.zip", [("http://x.com/", "Apache/2.2.15", MON), ("http://x.com/", "Microsoft-IIS/6.0", TUE),
+        ("http://x.com/", "Apache/2.2.15", "Thu, 03 Mar 2005 10:00:00 GMT")])
+    run_stages(root, STAGES, INCREMENTAL="1")
+    before = read_panel(root)
+
+    # y.com is crawled on the same days, in the opposite order
+    write_zip(root, "a.zip", [("http://y.com/", "nginx", TUE), ("http://y.com/", "nginx", MON)])
+    run_stages(root, STAGES, INCREMENTAL="1")
+    incremental = read_panel(root)
+    run_stages(root, ['balance_the_panel'])
+    return before, incremental, read_panel(root)
+
+def test_incremental_panel(panels):
+    before, incremental, full = panels
+    x = before.loc[before['domain']=='x.com']
+    assert list(x['server_name'].astype(str))==['Apache', 'Apache', 'Apache']
+    x = full.loc[full['domain']=='x.com']
+    assert list(x['server_name'].astype(str))==['IIS', 'Apache']
+    pd.testing.assert_frame_equal(incremental, full)
@@ -0,0 +1,49 @@
+# Checks that the outputs don't depend on the number of domain buckets. The pipeline is run up
+# to the dictionaries once on synthetic inputs, and the panel stages are then run on their own
+# copies of that with a single bucket and with more buckets than domains, so that there are
+# empty buckets and buckets whose only domain never had a Server header.
+import os
+import shutil
+import pandas as pd
+import pytest
+from conftest import REPO_DIR, run_stages
+from make_synthetic_inputs import write_inputs
+
+N_DOMAINS = 60
+
+@pytest.fixture(scope="module")
+def dictionaries(tmp_path_factory):
+    root = str(tmp_path_factory.mktemp("dictionaries"))
+    cwd = os.getcwd()
+    os.chdir(REPO_DIR)
+    try:
+        write_inputs(root, n_domains=N_DOMAINS, n_zips=1, n_crawl_files=2, months=24, seed=1)
+    finally:
+        os.chdir(cwd)
+    os.makedirs(os.path.join(root, "output"))
+    run_stages(root, ['extract_cookie_data','build_dictionaries','encode_servers','encode_dates'])
+    return root
+
+@pytest.fixture(scope="module")
+def outputs(dictionaries, tmp_path_factory):
+    roots = {}
+    for n_partitions in [1, 2*N_DOMAINS]:
+        root = str(tmp_path_factory.mktemp("partitions_%d" % n_partitions))
+        shutil.copytree(dictionaries, root, dirs_exist_ok=True)
+        run_stages(root, ['balance_the_panel','prepare_analytical_dataset'], N_PARTITIONS=str(n_partitions))
+        roots[n_partitions] = root
+    return roots[1], roots[2*N_DOMAINS]
+
+def test_balanced_panel(outputs):
+    one, many = [pd.read_hdf(os.path.join(root, "output/servers_panel_semibalanced.h5"), 'df') for root in outputs]
+    assert len(one)>0
+    pd.testing.assert_frame_equal(one, many)
+
+def test_analytical_panel(outputs):
+    one, many = [pd.read_stata(os.path.join(root, "output/servers_info_panel.dta")) for root in outputs]
+    assert len(one)>0
+    pd.testing.assert_frame_equal(one, many)
+
+def test_market_share_cube(outputs):
+    one, many = [pd.read_parquet(os.path.join(root, "output/market_share_cube.parquet")) for root in outputs]
+    pd.testing.assert_frame_equal(one, many)
@@ -0,0 +1,39 @@
+# Checks that the vectorized classification of the server headers gives the same vendors and
+# versions as encode_server_string, which checks one header at a time for each vendor in turn,
+# and that the cached classifications are redone when the vendors change.
+import pandas as pd
+import utils
+from make_synthetic_inputs import SERVERS
+
+HEADERS = [
+    "Apache", "Apache/2.2.15 (CentOS)", "Apache/1.3.27 (Unix) mod_ssl/2.8.14 OpenSSL/0.9.7", "Apache-Coyote/1.1",
+    "Apache/", "apache/2.0", "IBM_HTTP_Server", "IBM_HTTP_Server/6.0 Apache/2.0.47", "Oracle-HTTP-Server mod_ssl/2.8",
+    # Precedence between the vendors
+    "nginx/1.10.3 + Phusion Passenger Apache", "Microsoft-IIS/6.0 Apache/2.2", "nginx Microsoft-IIS/7.5",
+    "Netscape-Enterprise/4.1 mod_ssl", "Sun-ONE-Web-Server/6.1 SP5", "Netscape-Enterprise/6.0 Nginx",
+    "Nginx", "nginx", "NGINX", "openresty nginx/1.2", "Nginx/1.0 nginx/2.0",
+    # HTTPD at the start of the header or of a word, and elsewhere
+    "HTTPD", "HTTPD/1.0", "Oracle HTTPD", "xHTTPD", "IBM HTTPD Server", "thttpd/2.25b",
+    # Whitespace and embedded newlines
+    " Apache/2.4.7 (Ubuntu) ", "Apache\n", "Apache/2.4\nnginx", "foo\nApache/2.2", "nginx\n/1.2", "\nIIS/8.5",
+    "Microsoft-IIS/5.0\r\n", "HTTPD\nApache", "foo\nHTTPD",
+    # Other vendors and degenerate headers
+    "lighttpd/1.4.19", "GWS", "cloudflare", "", " ", "/", "IIS", "IIS/", "Microsoft-IIS/10.0",
+    ]
+
+def test_classify_server_strings():
+    headers = pd.Series(HEADERS + [server for server, _ in SERVERS if server is not None], dtype=object)
+    output = utils.classify_server_strings(headers)
+    expected = pd.DataFrame([utils.encode_server_string(server) for server in headers],
+        columns=['server_name','server_version'])
+    for col in ['server_name','server_version']:
+        assert list(output[col].where(output[col].notnull(), None))==list(expected[col].where(expected[col].notnull(), None))
+
+def test_classify_servers_cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    headers = pd.Series(["IBM_HTTP_Server", "nginx"])
+    assert list(utils.classify_servers(headers)['server_name'])==['Apache', 'Nginx']
+    vendors = [('IBM', regex) if regex.pattern=='mod_ssl|IBM_HTTP_Server' else (name, regex)
+        for name, regex in utils.SERVER_VENDORS]
+    monkeypatch.setattr(utils, 'SERVER_VENDORS', vendors)
+    assert list(utils.classify_servers(headers)['server_name'])==['IBM', 'Nginx']